@@ -0,0 +1,171 @@
+"""Run labels -> ack -> mail merge on many folders without the GUI.
+
+    python ack_batch.py "Parishes/*" "Appeals/Spring 2024" --reviewed --workers 4
+
+Each folder runs in its own process and its output goes to ack_batch.log in the folder.
+The GUI's confirmations are replaced by flags, and a summary of timings and failures
+is printed at the end, along with the time spent in every load, step and label rule
+(see timings.py). PySide6 is not needed.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from tabulate import tabulate as tb
+import csv_reader
+from ack_letter import AckLetterProcessor
+from labels import LabelProcessor
+from mail_merge import MailMerge, find_docx_template, find_latest_complete_csv
+from timings import STAGE, Recorder
+
+STAGES = ['labels', 'ack', 'merge']
+
+# Written in each folder processed
+LOG_NAME = 'ack_batch.log'
+
+class FolderLogger:
+    """Logger for the processors that prints messages and leaves out status lines."""
+    def log(self, message, update_only=False):
+        if not update_only:
+            print(message)
+
+class StageFailed(Exception):
+    pass
+
+def find_folders(patterns):
+    """Folders named or matched by the glob patterns, sorted and without duplicates."""
+    folders = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern) if glob.has_magic(pattern) else [pattern]
+        folders.update(os.path.abspath(path) for path in matches if os.path.isdir(path))
+    return sorted(folders)
+
+def run_labels(folder, options, recorder):
+    if not glob.glob(os.path.join(folder, '*_export.[Cc][Ss][Vv]')):
+        raise StageFailed("no _export.csv found")
+    if not options.reviewed:
+        raise StageFailed("Genders, Titles and notes must be reviewed first, run again with --reviewed")
+    processor = LabelProcessor(folder, chunk_size=options.chunk_size, max_memory_mb=options.max_memory_mb,
+                               workers=options.stage_workers, recorder=recorder)
+    if not processor.process_files():
+        raise StageFailed("title/gender errors, see _title_gender_errors.csv")
+
+def run_ack(folder, options, recorder):
+    processor = AckLetterProcessor(folder, FolderLogger(), recorder=recorder)
+    processor.set_continue_without_fidelis(options.without_fidelis)
+    if not processor.process_files():
+        raise StageFailed("mailing data not formatted, see " + LOG_NAME)
+
+def run_merge(folder, options, recorder):
+    template_path = options.template or find_docx_template(folder)
+    if not glob.glob(os.path.join(folder, '*_complete.csv')):
+        raise StageFailed("no _complete.csv found")
+    mail_merge = MailMerge(folder, FolderLogger(), workers=options.stage_workers, streaming=options.streaming,
+                           batch_size=options.batch_size, group_by=options.group_by, recorder=recorder)
+    mail_merge.merge(find_latest_complete_csv(folder), template_path, options.batches)
+
+STAGE_FUNCTIONS = {'labels': run_labels, 'ack': run_ack, 'merge': run_merge}
+
+def process_folder(folder, options):
+    """Run the stages on one folder, logging to LOG_NAME in it.
+
+    Returns {stage: seconds} for the stages that ran, the error that stopped the folder
+    or None, and the timings.Spans recorded.
+    """
+    # Set in the folder's own process, pool processes don't inherit module state everywhere
+    csv_reader.default_engine = options.engine
+    recorder = Recorder(options.memory)
+    error = None
+    with open(os.path.join(folder, LOG_NAME), 'w', encoding='utf-8') as log, redirect_stdout(log):
+        for stage in options.stages:
+            print(f"\n== {stage} ==")
+            try:
+                with recorder.measure(stage, STAGE):
+                    STAGE_FUNCTIONS[stage](folder, options, recorder)
+            except Exception as e:
+                print(f"{stage} failed: {e}")
+                error = f"{stage}: {e}"
+                break
+        print()
+        print(recorder.summary_table())
+    timings = {span.name: span.seconds for span in recorder.spans if span.kind == STAGE}
+    return timings, error, recorder.spans
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run labels -> ack -> mail merge on many folders without the GUI.")
+    parser.add_argument('folders', nargs='+', help="folders or glob patterns, e.g. 'Parishes/*'")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help="stages to run, in order")
+    parser.add_argument('--reviewed', action='store_true',
+                        help="confirm Genders, Titles and notes in every _export.csv were reviewed (needed for labels)")
+    parser.add_argument('--without-fidelis', action='store_true', help="go on when a folder has no Fidelis.csv")
+    parser.add_argument('--template', help="DOCX template for every folder, by default the one .docx in each folder")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="folders processed at once")
+    parser.add_argument('--stage-workers', type=int, default=1,
+                        help="processes each folder's labels and merge may use on top (default 1)")
+    parser.add_argument('--chunk-size', type=int, help="clean exports in chunks of this many rows")
+    parser.add_argument('--max-memory-mb', type=int,
+                        help="clean exports in chunks sized to keep each folder's labels stage under this many MB")
+    parser.add_argument('--engine', choices=['c', 'pyarrow'], default=csv_reader.default_engine,
+                        help="CSV parser, pyarrow's is multithreaded when pyarrow is installed")
+    parser.add_argument('--streaming', action='store_true', help="write merged letters with the streaming writer")
+    parser.add_argument('--batch-size', type=int, help="split merged letters into files of at most this many")
+    parser.add_argument('--group-by', help="split merged letters into one file per value of this column")
+    parser.add_argument('--batches', nargs='+', metavar='LABEL',
+                        help="with --batch-size or --group-by, only write these files again, e.g. ones that failed")
+    parser.add_argument('--timings', metavar='FILE', help="save the time of every stage, load, step and rule as JSON")
+    parser.add_argument('--trace', metavar='FILE', help="save them as a Chrome trace, for chrome://tracing or Perfetto")
+    parser.add_argument('--memory', action='store_true', help="also measure peak memory, makes the run slower")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.template:
+        options.template = os.path.abspath(options.template)
+    folders = find_folders(options.folders)
+    if not folders:
+        print("No folders found")
+        return 1
+
+    results = {}
+    recorder = Recorder(options.memory)
+    started = time.perf_counter()
+    workers = max(1, min(options.workers, len(folders)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_folder, folder, options): folder for folder in folders}
+        for done, future in enumerate(as_completed(futures), 1):
+            folder = futures[future]
+            try:
+                timings, error, spans = future.result()
+            except Exception as e:
+                # The folder's process itself failed, e.g. its log can't be written
+                timings, error, spans = {}, str(e), []
+            results[folder] = timings, error
+            recorder.spans.extend(spans)
+            print(f"[{done}/{len(folders)}] {os.path.basename(folder)}: {'failed' if error else 'done'} "
+                  f"in {sum(timings.values()):.1f}s")
+
+    rows = []
+    for folder in folders:
+        timings, error = results[folder]
+        rows.append([os.path.basename(folder)] + [f"{timings[stage]:.1f}" if stage in timings else ''
+                                                  for stage in options.stages]
+                    + [f"{sum(timings.values()):.1f}", error or 'ok'])
+    print()
+    print(tb(rows, headers=['Folder'] + [f"{stage} (s)" for stage in options.stages] + ['Total (s)', 'Result'],
+             tablefmt='grid'))
+    print()
+    print(recorder.summary_table())
+    if options.timings:
+        recorder.save_json(options.timings)
+    if options.trace:
+        recorder.save_chrome_trace(options.trace)
+    failed = sum(1 for _, error in results.values() if error)
+    print(f"{len(folders) - failed} of {len(folders)} folders done in {time.perf_counter() - started:.1f}s. "
+          f"Each folder's output is in its {LOG_NAME}.")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
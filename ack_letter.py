@@ -1,8 +1,10 @@
+import numpy as np
 import pandas as pd
 import glob
 import os
-from tabulate import tabulate
-from PySide6.QtGui import QTextCursor
+from csv_reader import read_csv, read_table, save_table
+from progress import check_cancelled
+from timings import LOAD, STEP, WRITE, measure
 
 class Logger:
     def __init__(self, log_function, is_qtext_edit=False):
@@ -11,6 +13,8 @@ class Logger:
 
     def log(self, message, update_only=False):
         if self.is_qtext_edit and update_only:
+            # Only needed with a Qt widget, the batch command runs without PySide6
+            from PySide6.QtGui import QTextCursor
             cursor = self.log_function.textCursor()
             cursor.movePosition(QTextCursor.End)
             cursor.select(QTextCursor.LineUnderCursor)
@@ -20,10 +24,81 @@ class Logger:
             self.log_function(message)
 
 
+# Visitor records are left out of the reconciliation and the letters
+VISITOR_PATTERN = 'Visitors -|Visitor -'
+
+# Reports written by check_for_missing_records. The names must not end in _mail, _export,
+# _clean or _complete so the next run doesn't pick them up as input.
+MISSING_IN_MAIL_REPORT = 'Reconciliation - no gifts in mail.csv'
+MISSING_IN_CLEAN_REPORT = 'Reconciliation - not in export clean.csv'
+
+# Recognition lists. Fidelis.csv sits in the input folder, any other list is a CSV with a
+# 'Constituent ID' column in the Societies subfolder, flagged in a column named after the
+# file (e.g. 'Legacy Society.csv', 'Monthly Donors.csv').
+FIDELIS_COLUMN = 'Fidelis Society'
+SOCIETIES_FOLDER = 'Societies'
+
+# Columns of the _mail.csv export used by the ack stage and how they are loaded. The rest
+# of the export is skipped at read time.
+MAIL_SCHEMA = {
+    'Constituent ID': 'text',
+    'Addressee': 'text',
+    'Salutation': 'text',
+    'Address line 1': 'text',
+    'Address line 2': 'text',
+    'Address line 3': 'text',
+    'City': 'text',
+    'State': 'text',
+    'ZIP Code': 'text',
+    'Gift type': 'text',
+    'Gift subtype': 'text',
+    'Amount': 'currency',
+    'Fund description_1': 'text',
+    'Gift date': 'date',
+    'Pay Method': 'text',
+    'Installment Frequency': 'text',
+}
+
+# Columns of the _complete.csv, followed by one flag column per society
+COMPLETE_COLUMNS = ['Constituent ID', 'Addressee', 'Salutation', 'Address_Line_1', 'Address line 2', 'Address line 3',
+                    'City', 'State', 'ZIP_Code', 'Gift type', 'Gift subtype', 'Amount', 'Fund description_1', 'Gift date',
+                    'Pay Method', 'Installment Frequency']
+
+# Date format of the mail export, e.g. 1/5/2024 or 01/05/2024
+MAIL_DATE_FORMAT = '%m/%d/%Y'
+
+def parse_currency(values):
+    """'$1,000.00' -> 1000.0, keeping only digits and the decimal point."""
+    return pd.to_numeric(values.str.replace(r'[^\d.]', '', regex=True), errors='coerce')
+
+def parse_date(values):
+    """Parse dates with MAIL_DATE_FORMAT, inferring the format only for values that don't match it."""
+    dates = pd.to_datetime(values, format=MAIL_DATE_FORMAT, errors='coerce')
+    unmatched = dates.isna() & values.notna()
+    if unmatched.any():
+        dates[unmatched] = pd.to_datetime(values[unmatched], errors='coerce')
+    return dates
+
+def is_visitor(addressees):
+    return addressees.str.contains(VISITOR_PATTERN, regex=True, na=False)
+
+def flag_societies(df_mail, societies):
+    """Add one column per society holding its name for members and '' for everyone else."""
+    for column, members in societies.items():
+        # Hashed once per list, then one vectorized lookup for all gift rows
+        member_ids = pd.Index(members['Constituent ID'].dropna().unique())
+        df_mail[column] = np.where(df_mail['Constituent ID'].isin(member_ids), column, '')
+    return df_mail
+
 class AckLetterProcessor:
-    def __init__(self, input_dir, logger):
+    def __init__(self, input_dir, logger, cancel=None, recorder=None):
+        """cancel is a threading.Event checked between the steps of process_files. Setting it
+        raises progress.Cancelled. recorder is a timings.Recorder that gets the loads, the
+        steps of process_data and the write."""
         self.input_dir = input_dir
         self.logger = logger
+        self.cancel = cancel
+        self.recorder = recorder
         self.continue_without_fidelis = False
 
     def set_continue_without_fidelis(self, decision):
@@ -33,62 +108,99 @@ class AckLetterProcessor:
         """Find CSV files in the specified directory matching a given pattern."""
         return glob.glob(os.path.join(self.input_dir, pattern))
 
+    def find_society_files(self):
+        """Return {flag column: csv path} for Fidelis.csv and every CSV in the Societies folder."""
+        society_files = {}
+        fidelis_files = self.find_csv_files('Fidelis.[Cc][Ss][Vv]')
+        if fidelis_files:
+            society_files[FIDELIS_COLUMN] = fidelis_files[0]
+        for path in sorted(self.find_csv_files(os.path.join(SOCIETIES_FOLDER, '*.[Cc][Ss][Vv]'))):
+            society_files[os.path.splitext(os.path.basename(path))[0]] = path
+        return society_files
+
     def read_csv_file(self, file_path):
-        """Attempt to read a CSV file with multiple encodings."""
-        try:
-            # Try reading with UTF-8 first
-            return pd.read_csv(file_path, encoding='utf-8'), 'utf-8'
-        except UnicodeDecodeError:
-            # If UTF-8 fails, try ISO-8859-1
-            return pd.read_csv(file_path, encoding='ISO-8859-1'), 'ISO-8859-1'
-
-    def check_for_missing_records(self, df_mail, df_clean):
-        """Check for missing Constituent IDs in mail and clean files and print them, including Addressee details, excluding visitors."""
-        # Filter out records containing 'Visitors -' or 'Visitor -' in the Addressee fields
-        df_mail_filtered = df_mail.loc[~df_mail['Addressee'].str.contains('Visitors -|Visitor -', regex=True, na=False)]
-        df_clean_filtered = df_clean.loc[~df_clean['CnAdrSal_Addressee'].str.contains('Visitors -|Visitor -', regex=True, na=False)]
-
-        # Create sets of Constituent IDs
-        mail_ids = set(df_mail_filtered['Constituent ID'])
-        clean_ids = set(df_clean_filtered['CnBio_ID'])
+        """Read a CSV file with its sniffed encoding, returning the frame and the encoding."""
+        return read_csv(file_path)
+
+    def read_mail_file(self, file_path):
+        """Read only the MAIL_SCHEMA columns of a _mail.csv, with Amount and Gift date typed."""
+        df_mail, encoding = read_csv(file_path, usecols=list(MAIL_SCHEMA), dtype=str)
+        for column, kind in MAIL_SCHEMA.items():
+            if kind == 'currency':
+                df_mail[column] = parse_currency(df_mail[column])
+            elif kind == 'date':
+                df_mail[column] = parse_date(df_mail[column])
+        return df_mail, encoding
+
+    def read_clean_files(self, clean_files):
+        """Read every _clean.csv, one per cleaned export, into one frame.
+
+        Records in more than one file keep the add/sal of the first file by name.
+        """
+        frames = [read_table(path, dtype={'CnBio_ID': str})[0] for path in sorted(clean_files)]
+        if len(frames) > 1:
+            self.logger.log(f"Using {len(frames)} cleaned exports: {', '.join(os.path.basename(path) for path in sorted(clean_files))}")
+        return pd.concat(frames, ignore_index=True)
+
+    def check_for_missing_records(self, df_mail, df_clean, encoding='utf-8'):
+        """Check for Constituent IDs that are only in the mail or only in the clean file, excluding visitors.
+
+        df_mail is expected without visitor rows already. The mismatches are saved as CSV
+        reports in the input folder and only counted in the log. Returns both lists.
+        """
+        df_clean_filtered = df_clean.loc[~is_visitor(df_clean['CnAdrSal_Addressee'])]
+
+        # ID -> Addressee of the first record with that ID, built once per file
+        clean_addressees = df_clean_filtered.drop_duplicates(subset=['CnBio_ID']).set_index('CnBio_ID')['CnAdrSal_Addressee']
+        mail_addressees = df_mail.drop_duplicates(subset=['Constituent ID']).set_index('Constituent ID')['Addressee']
 
         # Identify missing records
-        missing_in_mail = clean_ids - mail_ids
-        missing_in_clean = mail_ids - clean_ids
-
-        # Prepare data for table format
-        missing_mail_data = [(cid, df_clean_filtered[df_clean_filtered['CnBio_ID'] == cid]['CnAdrSal_Addressee'].values[0])
-                             for cid in missing_in_mail]
-        missing_clean_data = [(cid, df_mail_filtered[df_mail_filtered['Constituent ID'] == cid]['Addressee'].values[0])
-                              for cid in missing_in_clean]
-
-        # Print details of missing records in table format
-        if missing_in_mail:
-            self.logger.log("\nRecords found in _export_clean.csv' but not in '_mail.csv'")
-            self.logger.log("They have no giving information. They will not be final output.")
-            self.logger.log(tabulate(missing_mail_data, headers=["ID", "Addressee"], tablefmt="grid"))
-
-        if missing_in_clean:
-            self.logger.log("\nRecords in '_mail.csv' but not in '_export_clean.csv':")
-            self.logger.log("They have giving information, but Add/Sal might incorrect. They will be in final output.")
-            self.logger.log(tabulate(missing_clean_data, headers=["ID", "Addressee"], tablefmt="grid"))
+        missing_in_mail = clean_addressees.loc[clean_addressees.index.difference(mail_addressees.index)]
+        missing_in_clean = mail_addressees.loc[mail_addressees.index.difference(clean_addressees.index)]
+
+        self._save_missing_records(missing_in_mail, MISSING_IN_MAIL_REPORT, encoding, [
+            "\nRecords found in _export_clean.csv' but not in '_mail.csv'",
+            "They have no giving information. They will not be final output.",
+        ])
+        self._save_missing_records(missing_in_clean, MISSING_IN_CLEAN_REPORT, encoding, [
+            "\nRecords in '_mail.csv' but not in '_export_clean.csv':",
+            "They have giving information, but Add/Sal might incorrect. They will be in final output.",
+        ])
+        return missing_in_mail, missing_in_clean
+
+    def _save_missing_records(self, addressees, report_name, encoding, messages):
+        report_path = os.path.join(self.input_dir, report_name)
+        if addressees.empty:
+            # Don't leave last run's list behind
+            if os.path.exists(report_path):
+                os.remove(report_path)
+            return
+        for message in messages:
+            self.logger.log(message)
+        pd.DataFrame({'ID': addressees.index, 'Addressee': addressees.to_numpy()}).to_csv(report_path, index=False, encoding=encoding)
+        self.logger.log(f"{len(addressees)} records saved to '{report_name}'")
 
     def process_files(self):
         # Find files
         mail_files = self.find_csv_files('*_mail.[Cc][Ss][Vv]')
         clean_files = self.find_csv_files('*_clean.[Cc][Ss][Vv]')
-        fidelis_files = self.find_csv_files('Fidelis.[Cc][Ss][Vv]')
+        society_files = self.find_society_files()
 
         # Read files and capture encoding used
         if mail_files:
-            df_mail, mail_encoding = self.read_csv_file(mail_files[0])
+            with measure(self.recorder, 'read _mail.csv', LOAD) as span:
+                df_mail, mail_encoding = self.read_mail_file(mail_files[0])
+                span.rows = len(df_mail)
         else:
             df_mail, mail_encoding = None, None
+        check_cancelled(self.cancel)
 
         if clean_files:
-            df_clean, clean_encoding = self.read_csv_file(clean_files[0])
+            with measure(self.recorder, 'read _clean.csv', LOAD) as span:
+                df_clean = self.read_clean_files(clean_files)
+                span.rows = len(df_clean)
         else:
-            df_clean, clean_encoding = None, None
+            df_clean = None
 
         # Check if required files are loaded
         if df_mail is None or df_clean is None:
@@ -96,92 +208,106 @@ class AckLetterProcessor:
             return
 
         # Check for Fidelis.csv and handle accordingly
-        fidelis_used = False
-        if not fidelis_files:
-            if not self.continue_without_fidelis:
-                self.logger.log("Exiting, please add the Fidelis.csv file and run the script again")
-                return
-            else:
-                df_fidelis = None
-        else:
-            df_fidelis, fidelis_encoding = self.read_csv_file(fidelis_files[0])
-            fidelis_used = True
+        if FIDELIS_COLUMN not in society_files and not self.continue_without_fidelis:
+            self.logger.log("Exiting, please add the Fidelis.csv file and run the script again")
+            return
+        # A flag column named like a mail or letter column would overwrite it
+        clashes = [column for column in society_files if column in MAIL_SCHEMA or column in COMPLETE_COLUMNS]
+        if clashes:
+            self.logger.log(f"Exiting, rename the society lists named like a mailing data column: "
+                            f"{', '.join(os.path.basename(society_files[column]) for column in clashes)}")
+            return
+        # IDs are text in every file so they join as is, leading zeros included
+        with measure(self.recorder, 'read societies', LOAD) as span:
+            societies = {column: read_csv(path, dtype={'Constituent ID': str})[0] for column, path in society_files.items()}
+            span.rows = sum(len(members) for members in societies.values())
+        check_cancelled(self.cancel)
+
+        # Visitors are filtered once, for the reconciliation and the letters
+        df_mail = df_mail.loc[~is_visitor(df_mail['Addressee'])].copy()
 
         # Check for missing records
-        self.check_for_missing_records(df_mail, df_clean)
+        with measure(self.recorder, 'check for missing records', STEP, len(df_mail)):
+            self.check_for_missing_records(df_mail, df_clean, mail_encoding)
+        check_cancelled(self.cancel)
 
         # Process files according to defined functions
-        processed_data = self.process_data(df_mail, df_clean, df_fidelis, fidelis_used)
+        with measure(self.recorder, 'process_data', STEP, len(df_mail)):
+            processed_data = self.process_data(df_mail, df_clean, societies)
+        check_cancelled(self.cancel)
 
         # Use the encoding that was successful for saving
         output_path = os.path.join(self.input_dir, f"{pd.Timestamp.now().strftime('%Y-%m-%d')} OCA Ack_complete.csv")
-        processed_data.to_csv(output_path, index=False, encoding=mail_encoding)
+        with measure(self.recorder, 'write _complete.csv', WRITE, len(processed_data)):
+            save_table(processed_data, output_path, mail_encoding)
         self.logger.log("\n")
         return f"Mailing data has been formatted. Ready for Word merge"
 
-    def process_data(self, df_mail, df_clean, df_fidelis, fidelis_used):
-        df_mail['Amount'] = df_mail['Amount'].astype(str).str.replace('[^\d.]', '', regex=True)
-        df_mail['Amount'] = pd.to_numeric(df_mail['Amount'], errors='coerce')
-        df_mail['Gift date'] = pd.to_datetime(df_mail['Gift date'], errors='coerce')
-        df_mail = df_mail.loc[~df_mail['Addressee'].str.contains('Visitors -|Visitor -', regex=True, na=False)].copy()
+    def process_data(self, df_mail, df_clean, societies):
+        """Build one letter row per constituent and fund. df_mail must already be without visitors.
 
+        societies maps a flag column name to the members list read from its CSV. df_mail is
+        expected as loaded by read_mail_file, with Amount and Gift date already typed.
+        """
         # Ensure that merge does not create duplicates by keeping the clean data unique per 'Constituent ID'
-        df_clean_unique = df_clean.drop_duplicates(subset=['CnBio_ID'])
-        df_mail = df_mail.merge(df_clean_unique[['CnBio_ID', 'CnAdrSal_Addressee', 'CnAdrSal_Salutation']],
-                                left_on='Constituent ID', right_on='CnBio_ID', how='left')
-        df_mail['Addressee'] = df_mail['CnAdrSal_Addressee'].combine_first(df_mail['Addressee'])
-        df_mail['Salutation'] = df_mail['CnAdrSal_Salutation'].combine_first(df_mail['Salutation'])
-        df_mail.drop(columns=['CnBio_ID', 'CnAdrSal_Addressee', 'CnAdrSal_Salutation'], inplace=True)
-
-        if fidelis_used:
-            fidelis_ids = df_fidelis['Constituent ID'].unique()
-            df_mail['Fidelis Society'] = df_mail['Constituent ID'].apply(lambda x: 'Fidelis Society' if x in fidelis_ids else '')
-        else:
-            df_mail['Fidelis Society'] = ''
-
-        grouped = df_mail.groupby(['Constituent ID', 'Fund description_1'])
-        final_rows = []
-
-        for name, group in grouped:
-            selected_data = group[group['Gift type'] == 'Pledge'] if 'Pledge' in group['Gift type'].values else group
-            amount_sum = selected_data['Amount'].sum()
-            latest_date = selected_data['Gift date'].max()
-            gift_type = 'Pledge' if 'Pledge' in selected_data['Gift type'].values else 'Cash'
-
-            final_row = {
-                'Constituent ID': name[0],
-                'Addressee': group['Addressee'].iloc[0],
-                'Salutation': group['Salutation'].iloc[0],
-                'Address_Line_1': group['Address line 1'].iloc[0],
-                'Address line 2': group['Address line 2'].iloc[0],
-                'Address line 3': group['Address line 3'].iloc[0],
-                'City': group['City'].iloc[0],
-                'State': group['State'].iloc[0],
-                'ZIP_Code': group['ZIP Code'].iloc[0],
-                'Gift type': gift_type,
-                'Gift subtype': group['Gift subtype'].iloc[0],
-                'Amount': amount_sum,
-                'Fund description_1': name[1],
-                'Gift date': latest_date,
-                'Pay Method': group['Pay Method'].iloc[0],
-                'Installment Frequency': group['Installment Frequency'].iloc[0],
+        with measure(self.recorder, 'join add/sal', STEP, len(df_mail)):
+            df_clean_unique = df_clean.drop_duplicates(subset=['CnBio_ID'])
+            df_mail = df_mail.merge(df_clean_unique[['CnBio_ID', 'CnAdrSal_Addressee', 'CnAdrSal_Salutation']],
+                                    left_on='Constituent ID', right_on='CnBio_ID', how='left')
+            df_mail['Addressee'] = df_mail['CnAdrSal_Addressee'].combine_first(df_mail['Addressee'])
+            df_mail['Salutation'] = df_mail['CnAdrSal_Salutation'].combine_first(df_mail['Salutation'])
+            df_mail.drop(columns=['CnBio_ID', 'CnAdrSal_Addressee', 'CnAdrSal_Salutation'], inplace=True)
+
+        with measure(self.recorder, 'flag societies', STEP, len(df_mail)):
+            flag_societies(df_mail, societies)
+
+        # One row per constituent and fund. Groups with a pledge only count their pledge
+        # rows, the address details come from the first row of each group.
+        keys = ['Constituent ID', 'Fund description_1']
+        with measure(self.recorder, 'group gifts', STEP, len(df_mail)):
+            df_mail = df_mail.dropna(subset=keys)
+            is_pledge = df_mail['Gift type'] == 'Pledge'
+            has_pledge = is_pledge.groupby([df_mail[key] for key in keys]).transform('any')
+            selected = is_pledge | ~has_pledge
+            grouped = df_mail.assign(
+                _row=np.arange(len(df_mail)),
+                _pledge=is_pledge,
+                _amount=df_mail['Amount'].where(selected),
+                _date=df_mail['Gift date'].where(selected),
+            ).groupby(keys).agg(
+                first_row=('_row', 'min'),
+                pledge=('_pledge', 'any'),
+                amount=('_amount', 'sum'),
+                latest_date=('_date', 'max'),
+            )
+
+        with measure(self.recorder, 'build letters', STEP, len(grouped)):
+            first_columns = {
+                'Addressee': 'Addressee',
+                'Salutation': 'Salutation',
+                'Address line 1': 'Address_Line_1',
+                'Address line 2': 'Address line 2',
+                'Address line 3': 'Address line 3',
+                'City': 'City',
+                'State': 'State',
+                'ZIP Code': 'ZIP_Code',
+                'Gift subtype': 'Gift subtype',
+                'Pay Method': 'Pay Method',
+                'Installment Frequency': 'Installment Frequency',
             }
-
-            if fidelis_used:
-                final_row['Fidelis Society'] = group['Fidelis Society'].iloc[0]
-
-            final_rows.append(final_row)
-
-        final_data = pd.DataFrame(final_rows)
-        column_order = ['Constituent ID', 'Addressee', 'Salutation', 'Address_Line_1', 'Address line 2', 'Address line 3',
-                        'City', 'State', 'ZIP_Code', 'Gift type', 'Gift subtype', 'Amount', 'Fund description_1', 'Gift date', 'Pay Method', 'Installment Frequency']
-
-        if fidelis_used:
-            column_order.append('Fidelis Society')
-        # reorder columns
-        final_data = final_data[column_order]
-        # change gift type wording
-        final_data['Gift type'] = final_data['Gift type'].replace({'Cash': 'gift', 'Pledge': 'pledge'})
+            for column in societies:
+                first_columns[column] = column
+            final_data = df_mail[list(first_columns)].take(grouped['first_row'].to_numpy()).rename(columns=first_columns)
+            final_data.index = grouped.index
+            final_data = final_data.reset_index()
+            # change gift type wording
+            final_data['Gift type'] = np.where(grouped['pledge'].to_numpy(), 'pledge', 'gift')
+            # Whole cents, so sums like 51.989999999999995 read and print as 51.99
+            final_data['Amount'] = grouped['amount'].round(2).to_numpy()
+            final_data['Gift date'] = grouped['latest_date'].to_numpy()
+
+            # reorder columns
+            final_data = final_data[COMPLETE_COLUMNS + list(societies)]
 
         return final_data
 
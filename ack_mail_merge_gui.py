@@ -1,26 +1,151 @@
-from PySide6.QtWidgets import QApplication, QMainWindow, QFileDialog, QPushButton, QVBoxLayout, QWidget, QLabel, QMessageBox, QTextEdit
-from PySide6.QtCore import QIODevice, QThread, Signal, Qt
+from PySide6.QtWidgets import QApplication, QMainWindow, QFileDialog, QPushButton, QVBoxLayout, QWidget, QLabel, QMessageBox, QPlainTextEdit, QProgressBar
+from PySide6.QtCore import QIODevice, QObject, QRunnable, QThreadPool, QTimer, Signal, Qt
 from PySide6.QtGui import QTextCursor
 import sys
 import os
 import glob
-from mail_merge import MailMerge, find_latest_complete_csv, Logger
+import logging
+import threading
+from collections import deque
+from logging.handlers import RotatingFileHandler
+import csv_reader
+from mail_merge import MailMerge, find_latest_complete_csv
 from ack_letter import AckLetterProcessor
 from labels import LabelProcessor
+from progress import Cancelled, format_progress
+from timings import STAGE, Recorder
+
+# Lines kept in the log view, older lines are dropped
+LOG_MAX_BLOCKS = 5000
+
+# Milliseconds between two updates of the log view
+LOG_FLUSH_MS = 100
+
+# Set to a file name to also keep the log on disk, rotated at LOG_FILE_BYTES
+LOG_FILE = None
+LOG_FILE_BYTES = 5 * 2**20
+LOG_FILE_BACKUPS = 3
+
+# CSV parser, 'c' or 'pyarrow' for pyarrow's multithreaded reader when it is installed
+CSV_ENGINE = 'c'
+
+# Set either one to clean large exports in chunks instead of loading them whole: rows per
+# chunk, or the peak memory in MB the label stage should stay under
+LABEL_CHUNK_SIZE = None
+LABEL_MAX_MEMORY_MB = None
+
+# Set one to split the merged letters into files of at most MERGE_BATCH_SIZE letters or
+# one file per value of the MERGE_GROUP_BY column. MERGE_BATCHES then limits the merge to
+# the files with those labels, e.g. ['FL'] to write again one that failed.
+MERGE_BATCH_SIZE = None
+MERGE_GROUP_BY = None
+MERGE_BATCHES = None
+
+# Set to file names to save the timings of every stage run in the session as JSON and as
+# a Chrome trace. The timings of each stage are also logged when it ends.
+TIMINGS_FILE = None
+TRACE_FILE = None
+# Also measure peak memory, which slows the stages down a lot
+TRACE_MEMORY = False
+
+class LogSink:
+    """Collects log messages and printed text, and appends them to a QPlainTextEdit in batches.
+
+    Writes only add to a pending buffer, which a timer flushes into the view every
+    LOG_FLUSH_MS. The view keeps at most LOG_MAX_BLOCKS lines. Writes may come from any
+    thread. With log_file, complete lines are also written to a rotating log file.
+    """
+    def __init__(self, text_edit, log_file=None):
+        self.text_edit = text_edit
+        self.text_edit.setMaximumBlockCount(LOG_MAX_BLOCKS)
+        self.lock = threading.Lock()
+        # Text to append, and whether it replaces the view's last line first
+        self.pending = ''
+        self.replace_last_line = False
+        self.at_line_start = True
+        # The last line is a status line from log(update_only=True)
+        self.status_line = False
+
+        self.file_logger = None
+        self.partial_line = ''
+        if log_file:
+            handler = RotatingFileHandler(log_file, maxBytes=LOG_FILE_BYTES, backupCount=LOG_FILE_BACKUPS, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self.file_logger = logging.getLogger('ack_mail_merge_gui')
+            self.file_logger.setLevel(logging.INFO)
+            self.file_logger.propagate = False
+            self.file_logger.addHandler(handler)
+
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.flush)
+        self.timer.start(LOG_FLUSH_MS)
+
+    def write(self, text):
+        """Append printed text as is, after the status line if there is one."""
+        with self.lock:
+            self._append('\n' + text if self.status_line else text)
+        self._write_file(text)
+
+    def log(self, message, update_only=False):
+        """Add message as a line of its own, or as the status line with update_only.
+
+        A status line replaces the previous one in place.
+        """
+        with self.lock:
+            if update_only:
+                # Only the newest status line is kept
+                if '\n' in self.pending:
+                    self.pending = self.pending[:self.pending.rfind('\n') + 1] + message
+                else:
+                    self.pending = message
+                    self.replace_last_line = True
+                self.at_line_start = False
+                self.status_line = True
+            else:
+                self._append(('' if self.at_line_start else '\n') + message + '\n')
+        if not update_only:
+            self._write_file(message + '\n')
+
+    def _append(self, text):
+        if text:
+            self.pending += text
+            self.at_line_start = text.endswith('\n')
+            self.status_line = False
+
+    def _write_file(self, text):
+        if self.file_logger is None:
+            return
+        lines = (self.partial_line + text).split('\n')
+        self.partial_line = lines.pop()
+        for line in lines:
+            self.file_logger.info(line)
+
+    def flush(self):
+        with self.lock:
+            text, replace_last_line = self.pending, self.replace_last_line
+            self.pending, self.replace_last_line = '', False
+        if not text and not replace_last_line:
+            return
+        scroll_bar = self.text_edit.verticalScrollBar()
+        at_bottom = scroll_bar.value() == scroll_bar.maximum()
+        # A cursor of its own so the user's selection is left alone
+        cursor = QTextCursor(self.text_edit.document())
+        cursor.movePosition(QTextCursor.End)
+        if replace_last_line:
+            cursor.movePosition(QTextCursor.StartOfBlock, QTextCursor.KeepAnchor)
+            cursor.removeSelectedText()
+        cursor.insertText(text)
+        if at_bottom:
+            scroll_bar.setValue(scroll_bar.maximum())
 
 class EmittingStream(QIODevice):
-    def __init__(self, text_edit):
+    def __init__(self, sink):
         super().__init__()
-        self.text_edit = text_edit
+        self.sink = sink
         self.open(QIODevice.WriteOnly)
 
     def writeData(self, data):
-        text = str(data, 'utf-8', errors='replace')
-        cursor = self.text_edit.textCursor()
-        cursor.movePosition(QTextCursor.End)
-        cursor.insertText(text)
-        self.text_edit.setTextCursor(cursor)
-        self.text_edit.ensureCursorVisible()
+        self.sink.write(str(data, 'utf-8', errors='replace'))
         return len(data)
 
     def write(self, text):
@@ -29,31 +154,54 @@ class EmittingStream(QIODevice):
     def flush(self):
         pass
 
-class Worker(QThread):
-    progress = Signal(str, bool)
-    finished = Signal(str)
+class Logger(QObject):
+    """Sends log messages to the GUI thread, whichever thread logs them."""
+    log_signal = Signal(str, bool)
+
+    def __init__(self):
+        super().__init__()
 
-    def __init__(self, output_dir, template_path):
+    def log(self, message, update_only=False):
+        self.log_signal.emit(message, update_only)
+
+class TaskSignals(QObject):
+    finished = Signal(object)
+    failed = Signal(str)
+    cancelled = Signal()
+
+class StageTask(QRunnable):
+    """One stage of the process, run on the shared QThreadPool.
+
+    func runs on a pool thread. cancel is the threading.Event given to the stage's
+    processor, which stops at its next check once it is set. The result, an error or the
+    cancellation come back to the GUI thread through signals. recorder is the
+    timings.Recorder given to the processor, the stage as a whole is measured too.
+    """
+    def __init__(self, name, func, on_finished, cancel, recorder):
         super().__init__()
-        self.output_dir = output_dir
-        self.template_path = template_path
+        self.setAutoDelete(False)
+        self.name = name
+        self.func = func
+        self.on_finished = on_finished
+        self.cancel = cancel
+        self.recorder = recorder
+        self.signals = TaskSignals()
 
     def run(self):
         try:
-            latest_csv = find_latest_complete_csv(self.output_dir)
-            self.progress.emit(f"", False)
-            logger = Logger()
-            logger.log_signal.connect(self.log)
-            mail_merge = MailMerge(self.output_dir, logger)
-            mail_merge.merge(latest_csv, self.template_path)
-            self.finished.emit("")
+            with self.recorder.measure(self.name, STAGE):
+                result = self.func()
+        except Cancelled:
+            self.signals.cancelled.emit()
         except Exception as e:
-            self.finished.emit(f"An error occurred during mail merge: {e}")
-
-    def log(self, message, update_only=False):
-        self.progress.emit(message, update_only)
+            self.signals.failed.emit(str(e))
+        else:
+            self.signals.finished.emit(result)
 
 class MainWindow(QMainWindow):
+    # Progress of the running stage, emitted from the pool thread
+    stage_progress = Signal(object)
+
     def __init__(self):
         super().__init__()
 
@@ -61,6 +209,15 @@ class MainWindow(QMainWindow):
         self.output_dir = os.getcwd()
         self.template_path = ''
         self.processor = None
+        csv_reader.default_engine = CSV_ENGINE
+
+        # Stages run one at a time on the shared pool, the next ones wait in the queue
+        self.thread_pool = QThreadPool.globalInstance()
+        self.current_task = None
+        self.queued_tasks = deque()
+        # Timings of the stages run so far, for TIMINGS_FILE and TRACE_FILE
+        self.timings = Recorder(TRACE_MEMORY)
+        self.stage_progress.connect(self.show_progress)
         self.initUI()
         self.check_required_files()
 
@@ -94,8 +251,18 @@ class MainWindow(QMainWindow):
         self.run_mail_merge_button.clicked.connect(self.run_mail_merge)
         self.run_mail_merge_button.setEnabled(False)
 
-        self.log_output = QTextEdit()
+        self.cancel_button = QPushButton('Cancel the running process')
+        self.cancel_button.clicked.connect(self.cancel_running)
+        self.cancel_button.setEnabled(False)
+
+        self.log_output = QPlainTextEdit()
         self.log_output.setReadOnly(True)
+        self.log_sink = LogSink(self.log_output, LOG_FILE)
+
+        # Stage, count, rate and time left of the running process
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setTextVisible(True)
+        self.progress_bar.hide()
 
         # Add widgets to layout
         layout.addWidget(self.select_folder_button)
@@ -103,6 +270,8 @@ class MainWindow(QMainWindow):
         layout.addWidget(self.run_ack_button)
         layout.addWidget(self.select_template_button)
         layout.addWidget(self.run_mail_merge_button)
+        layout.addWidget(self.cancel_button)
+        layout.addWidget(self.progress_bar)
         layout.addWidget(self.log_output)
 
         # Set the central widget
@@ -110,9 +279,9 @@ class MainWindow(QMainWindow):
         container.setLayout(layout)
         self.setCentralWidget(container)
 
-        # Redirect stdout to the QTextEdit widget
-        sys.stdout = EmittingStream(self.log_output)
-        # sys.stderr = EmittingStream(self.log_output)  # Keep stderr commented for now
+        # Redirect stdout to the log view
+        sys.stdout = EmittingStream(self.log_sink)
+        # sys.stderr = EmittingStream(self.log_sink)  # Keep stderr commented for now
 
         # Initialize logger
         self.logger = Logger()
@@ -171,14 +340,22 @@ class MainWindow(QMainWindow):
             QMessageBox.Yes | QMessageBox.No
         )
         if response == QMessageBox.Yes:
-            label_processor = LabelProcessor(self.input_dir)
-            if label_processor.process_files():
-                self.run_ack_button.setEnabled(True)
-            else:
-                print("Despite your 'review' of the data, errors in Genders and titles were found. These are only potentially some errors. Review _export.csv again")
+            cancel = threading.Event()
+            recorder = Recorder(TRACE_MEMORY)
+            label_processor = LabelProcessor(self.input_dir, chunk_size=LABEL_CHUNK_SIZE, max_memory_mb=LABEL_MAX_MEMORY_MB,
+                                             cancel=cancel, recorder=recorder)
+            # The next stage can be queued while this one runs
+            self.run_ack_button.setEnabled(True)
+            self.start_stage("Label processing", label_processor.process_files, self.labels_finished, cancel, recorder)
         else:
             QMessageBox.information(self, "Process Stopped")
 
+    def labels_finished(self, valid):
+        if not valid:
+            print("Despite your 'review' of the data, errors in Genders and titles were found. All of them are listed in the _title_gender_errors.csv report. Review _export.csv again")
+            self.run_ack_button.setEnabled(False)
+        return valid
+
     def run_ack_letter(self):
         confirm_message = (
             "This will use the cleaned data from _export while it formats the mailing data\n"
@@ -196,7 +373,9 @@ class MainWindow(QMainWindow):
 
         logger = Logger()
         logger.log_signal.connect(self.log_message)
-        self.processor = AckLetterProcessor(self.input_dir, logger)
+        cancel = threading.Event()
+        recorder = Recorder(TRACE_MEMORY)
+        self.processor = AckLetterProcessor(self.input_dir, logger, cancel, recorder)
         fidelis_files = self.processor.find_csv_files('Fidelis.[Cc][Ss][Vv]')
         if not fidelis_files:
             response = QMessageBox.question(
@@ -210,10 +389,13 @@ class MainWindow(QMainWindow):
                 return
             else:
                 self.processor.set_continue_without_fidelis(True)
-        result = self.processor.process_files()
+        self.select_template_button.setEnabled(True)
+        self.start_stage("Formatting mailing data", self.processor.process_files, self.ack_finished, cancel, recorder)
+
+    def ack_finished(self, result):
         if result:
             print(result)
-        self.select_template_button.setEnabled(True)
+        return bool(result)
 
     def select_template(self):
         options = QFileDialog.Options()
@@ -241,30 +423,113 @@ class MainWindow(QMainWindow):
             self.logger.log("Process stopped by the user.")
             return
 
-        # Call the worker for the mail merge process
-        self.worker = Worker(self.output_dir, self.template_path)
-        self.worker.progress.connect(self.log_message)
-        self.worker.finished.connect(self.on_merge_finished)
-        self.worker.start()
-
-    def on_merge_finished(self, message):
-        self.logger.log(message)
+        cancel = threading.Event()
+        recorder = Recorder(TRACE_MEMORY)
+        self.start_stage("Mail merge", lambda: self.merge_latest_csv(cancel, recorder), self.on_merge_finished, cancel,
+                         recorder)
+
+    def merge_latest_csv(self, cancel, recorder):
+        # Looked up when the merge starts, so a queued merge uses the file the ack stage just wrote
+        latest_csv = find_latest_complete_csv(self.output_dir)
+        mail_merge = MailMerge(self.output_dir, self.logger, batch_size=MERGE_BATCH_SIZE, group_by=MERGE_GROUP_BY,
+                               progress=self.stage_progress.emit, cancel=cancel, recorder=recorder)
+        mail_merge.merge(latest_csv, self.template_path, MERGE_BATCHES)
+
+    def on_merge_finished(self, result):
+        self.logger.log("")
+        return True
+
+    def start_stage(self, name, func, on_finished, cancel, recorder):
+        """Run func on the thread pool, or queue it when another stage is running.
+
+        on_finished gets func's result on the GUI thread and returns whether the queued
+        stages should go on.
+        """
+        task = StageTask(name, func, on_finished, cancel, recorder)
+        if self.current_task is None:
+            self.start_task(task)
+        else:
+            self.queued_tasks.append(task)
+            self.logger.log(f"{name} will start when {self.current_task.name} is done")
+
+    def start_task(self, task):
+        self.current_task = task
+        task.signals.finished.connect(self.task_finished)
+        task.signals.failed.connect(self.task_failed)
+        task.signals.cancelled.connect(self.task_cancelled)
+        self.cancel_button.setEnabled(True)
+        self.thread_pool.start(task)
+
+    def end_task(self):
+        task = self.current_task
+        self.current_task = None
+        self.cancel_button.setEnabled(False)
+        # Stages without progress reports must not show the last one's bar
+        self.progress_bar.reset()
+        self.progress_bar.hide()
+        return task
+
+    def report_timings(self, task):
+        """Log the timings of the stage that just ended and add them to the session's files."""
+        self.logger.log(f"Timings of {task.name.lower()}:\n{task.recorder.summary_table()}")
+        self.timings.spans.extend(task.recorder.spans)
+        if TIMINGS_FILE:
+            self.timings.save_json(TIMINGS_FILE)
+        if TRACE_FILE:
+            self.timings.save_chrome_trace(TRACE_FILE)
+
+    def task_finished(self, result):
+        task = self.end_task()
+        go_on = task.on_finished(result)
+        self.report_timings(task)
+        if go_on and self.queued_tasks:
+            self.start_task(self.queued_tasks.popleft())
+        else:
+            self.drop_queued_tasks()
+
+    def task_failed(self, message):
+        task = self.end_task()
+        self.logger.log(f"An error occurred during {task.name.lower()}: {message}")
+        self.report_timings(task)
+        self.stage_stopped(task)
+
+    def task_cancelled(self):
+        task = self.end_task()
+        self.logger.log(f"{task.name} cancelled")
+        self.report_timings(task)
+        self.stage_stopped(task)
+
+    def stage_stopped(self, task):
+        """Drop the queued stages after task failed or was cancelled."""
+        if task.name == "Label processing":
+            # Without a finished cleaned export there is nothing for the ack stage to use
+            self.run_ack_button.setEnabled(False)
+        self.drop_queued_tasks()
+
+    def drop_queued_tasks(self):
+        if self.queued_tasks:
+            self.logger.log(f"Not started: {', '.join(task.name for task in self.queued_tasks)}")
+            self.queued_tasks.clear()
+
+    def cancel_running(self):
+        """Stop the running stage at its next check and drop the queued ones."""
+        self.drop_queued_tasks()
+        if self.current_task is not None:
+            self.current_task.cancel.set()
+            self.logger.log(f"Cancelling {self.current_task.name.lower()}...")
+
+    def closeEvent(self, event):
+        self.cancel_running()
+        super().closeEvent(event)
+
+    def show_progress(self, progress):
+        self.progress_bar.setMaximum(max(progress.total, 1))
+        self.progress_bar.setValue(progress.done)
+        self.progress_bar.setFormat(format_progress(progress))
+        self.progress_bar.show()
 
     def log_message(self, message, update_only=False):
-        cursor = self.log_output.textCursor()
-        if update_only:
-            cursor.movePosition(QTextCursor.End)
-            cursor.select(QTextCursor.LineUnderCursor)
-            cursor.removeSelectedText()
-            cursor.insertText(message)
-        else:
-            cursor.movePosition(QTextCursor.End)
-            if not self.log_output.toPlainText().endswith('\n'):
-                cursor.insertBlock()
-            cursor.insertText(message)
-        self.log_output.setTextCursor(cursor)
-        self.log_output.ensureCursorVisible()
-        QApplication.processEvents()  # Ensure the GUI updates in real-time
+        self.log_sink.log(message, update_only)
 
 
 if __name__ == '__main__':
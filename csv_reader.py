@@ -0,0 +1,195 @@
+import codecs
+import csv
+import os
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = None
+
+# Exports are UTF-8 unless they come from an older RE install, which writes Latin-1
+FALLBACK_ENCODING = 'ISO-8859-1'
+
+# Bytes checked by sniff_encoding before the file is parsed
+SAMPLE_SIZE = 2**20
+
+# 'c' is pandas' own parser. Set to 'pyarrow' to parse with pyarrow's multithreaded
+# reader when it is installed.
+default_engine = 'c'
+
+# Same strings pandas treats as missing by default
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+             '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+
+def sniff_encoding(file_path, sample_size=SAMPLE_SIZE):
+    """Return 'utf-8' if the first sample_size bytes decode as UTF-8, otherwise FALLBACK_ENCODING.
+
+    sample_size=None checks the whole file, in blocks, without loading it.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    remaining = sample_size
+    try:
+        with open(file_path, 'rb') as f:
+            while remaining is None or remaining > 0:
+                block = f.read(SAMPLE_SIZE if remaining is None else min(SAMPLE_SIZE, remaining))
+                if not block:
+                    decoder.decode(b'', final=True)
+                    break
+                # A character cut in half at the end of the sample is kept for the next block
+                decoder.decode(block)
+                if remaining is not None:
+                    remaining -= len(block)
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING
+    return 'utf-8'
+
+
+def read_csv(file_path, engine=None, encoding=None, **kwargs):
+    """Parse a CSV once with its sniffed encoding. Returns the frame and the encoding used.
+
+    Only dtype and usecols are passed to the pyarrow engine, other options fall back to
+    pandas' parser.
+    """
+    encoding = encoding or sniff_encoding(file_path)
+    engine = engine or default_engine
+    try:
+        return _parse(file_path, engine, encoding, kwargs), encoding
+    except UnicodeDecodeError:
+        if encoding == FALLBACK_ENCODING:
+            raise
+        # Non UTF-8 bytes past the sniffed sample
+        return _parse(file_path, engine, FALLBACK_ENCODING, kwargs), FALLBACK_ENCODING
+
+
+def _parse(file_path, engine, encoding, kwargs):
+    if engine == 'pyarrow' and pa is not None and set(kwargs) <= {'dtype', 'usecols', 'low_memory'}:
+        return _parse_pyarrow(file_path, encoding, kwargs.get('dtype'), kwargs.get('usecols'))
+    if engine == 'pyarrow':
+        engine = 'c'
+    return pd.read_csv(file_path, encoding=encoding, engine=engine, **kwargs)
+
+
+def _convert_options(file_path, encoding, dtype, usecols):
+    convert_options = pa_csv.ConvertOptions(null_values=NA_VALUES, strings_can_be_null=True,
+                                            include_columns=list(usecols) if usecols else None)
+    if dtype is str:
+        # pyarrow would infer numbers first and drop leading zeros from IDs
+        with open(file_path, encoding=encoding, newline='') as f:
+            header = next(csv.reader(f), [])
+        convert_options.column_types = {name: pa.string() for name in header}
+    elif isinstance(dtype, dict):
+        convert_options.column_types = {name: pa.string() for name, kind in dtype.items() if kind is str}
+    return convert_options
+
+
+def _parse_pyarrow(file_path, encoding, dtype, usecols):
+    try:
+        table = pa_csv.read_csv(file_path, read_options=pa_csv.ReadOptions(encoding=encoding, use_threads=True),
+                                convert_options=_convert_options(file_path, encoding, dtype, usecols))
+    except pa.ArrowInvalid as e:
+        if 'UTF8' in str(e) or 'utf-8' in str(e).lower():
+            raise UnicodeDecodeError('utf-8', b'', 0, 1, str(e))
+        raise
+    return table.to_pandas()
+
+
+def read_csv_chunks(file_path, chunksize, encoding=None, engine=None, **kwargs):
+    """Iterate over a CSV in frames of chunksize rows, numbered on from the previous chunk.
+
+    The whole file is checked for its encoding unless one is given, so a late decode
+    error can't cut the output short. Like read_csv, only dtype and usecols are passed
+    to the pyarrow engine.
+    """
+    encoding = encoding or sniff_encoding(file_path, sample_size=None)
+    engine = engine or default_engine
+    if engine == 'pyarrow' and pa is not None and set(kwargs) <= {'dtype', 'usecols'}:
+        return _chunks_pyarrow(file_path, chunksize, encoding, kwargs.get('dtype'), kwargs.get('usecols'))
+    return pd.read_csv(file_path, encoding=encoding, chunksize=chunksize, **kwargs)
+
+
+def _chunks_pyarrow(file_path, chunksize, encoding, dtype, usecols):
+    # pyarrow reads in blocks of bytes, the record batches are regrouped into chunks of rows
+    reader = pa_csv.open_csv(file_path, read_options=pa_csv.ReadOptions(encoding=encoding),
+                             convert_options=_convert_options(file_path, encoding, dtype, usecols))
+    batches, rows, start = [], 0, 0
+    for batch in reader:
+        batches.append(batch)
+        rows += batch.num_rows
+        while rows >= chunksize:
+            table = pa.Table.from_batches(batches)
+            yield _chunk_frame(table.slice(0, chunksize), start)
+            start += chunksize
+            rest = table.slice(chunksize)
+            batches, rows = rest.to_batches(), rest.num_rows
+    if rows:
+        yield _chunk_frame(pa.Table.from_batches(batches), start)
+
+
+def _chunk_frame(table, start):
+    df = table.to_pandas()
+    df.index = pd.RangeIndex(start, start + len(df))
+    return df
+
+
+# Parquet copies written next to pipeline CSVs so the next stage can skip text parsing
+# and keep typed columns. The CSV is always written too, for staff to review and edit.
+write_intermediates = pa is not None
+
+
+def intermediate_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.parquet'
+
+
+def save_table(df, csv_path, encoding='utf-8'):
+    """Write df as csv_path and, when enabled, a Parquet intermediate next to it."""
+    df.to_csv(csv_path, index=False, encoding=encoding)
+    if write_intermediates:
+        try:
+            df.to_parquet(intermediate_path(csv_path), index=False)
+            return
+        except (pa.ArrowException, ValueError, TypeError):
+            # Mixed types in a column, the CSV alone will do
+            pass
+    remove_intermediate(csv_path)
+
+
+def remove_intermediate(csv_path):
+    """Delete a stale Parquet intermediate so it can't shadow a CSV written without one."""
+    parquet_path = intermediate_path(csv_path)
+    if os.path.exists(parquet_path):
+        os.remove(parquet_path)
+
+
+def read_table(csv_path, **kwargs):
+    """Read a pipeline CSV, loading its Parquet intermediate instead when it is at least as new.
+
+    Returns the frame and the CSV's encoding. A CSV edited after it was written is newer
+    than its intermediate, so staff changes are always picked up.
+    """
+    parquet_path = intermediate_path(csv_path)
+    if pa is not None and os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path):
+        return missing_as_csv(pd.read_parquet(parquet_path)), sniff_encoding(csv_path)
+    return read_csv(csv_path, **kwargs)
+
+
+def missing_as_csv(df):
+    """Turn text the CSV parser reads as missing ('' and the other NA_VALUES) into NaN, so
+    an intermediate loads the same frame as its CSV."""
+    na_values = set(NA_VALUES)
+    for col in df.columns:
+        if df[col].dtype == object or pd.api.types.is_string_dtype(df[col]) or isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].mask(df[col].isin(na_values))
+    return df
+
+
+def dates_as_csv_text(df):
+    """Format datetime columns the way to_csv writes them, so typed and CSV loads render alike."""
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            dates = df[col].dropna()
+            date_format = '%Y-%m-%d' if (dates == dates.dt.normalize()).all() else '%Y-%m-%d %H:%M:%S'
+            df[col] = df[col].dt.strftime(date_format)
+    return df
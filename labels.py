@@ -1,399 +1,699 @@
 import glob
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
 import pandas as pd
 import os
+import string
 from tabulate import tabulate as tb
-strictly_male_titles = ['Rev. Mr.', 'Deacon', 'Father', 'Brother', 'Monsignor', 'Reverend Monsignor', 'Mr.', 'Sr.']
-strictly_female_titles = ['Mrs.', 'Miss', 'Sister', 'Ms.']
+from csv_reader import read_csv, read_csv_chunks, remove_intermediate, save_table, sniff_encoding
+from progress import cancellable, check_cancelled
+from timings import LOAD, RULE, STEP, WRITE, Recorder, measure
+strictly_male_titles = frozenset(['Rev. Mr.', 'Deacon', 'Father', 'Brother', 'Monsignor', 'Reverend Monsignor', 'Mr.', 'Sr.'])
+strictly_female_titles = frozenset(['Mrs.', 'Miss', 'Sister', 'Ms.'])
 # List of all RE titles
-AllREtitles = ['Dr.', 'The Honorable', 'Col.', 'Cmsgt. Ret.', 'Rev. Mr.', 'Deacon', 'Judge', 
+AllREtitles = frozenset(['Dr.', 'The Honorable', 'Col.', 'Cmsgt. Ret.', 'Rev. Mr.', 'Deacon', 'Judge', 
                 'Lt. Col.', 'Col. Ret.', 'Major', 'Capt.', 'Maj. Gen.', 'Family of', 'Senator', 'Reverend', 
                 'Lt.', 'Cmdr.', 'Msgt.', 'Sister', 'Drs.', 'Master', 'Sgt. Maj.', 'SMSgt.', 'Prof.', 'Lt. Col. Ret.', 'Rev. Dr.', 
                 'Father', 'Brother', 'Bishop', 'Gen.', 'Admiral', 'Very Reverend', 'MMC', 'Monsignor', '1st Lt.', 'Reverend Monsignor', 
-                'Maj.', 'Most Reverend', 'Bishop Emeritus','Mrs.', 'Mr.', 'Ms.', 'Sra.', 'Señor', 'Miss','Sr.', 'Family of']
+                'Maj.', 'Most Reverend', 'Bishop Emeritus','Mrs.', 'Mr.', 'Ms.', 'Sra.', 'Señor', 'Miss','Sr.', 'Family of'])
 
 # List of  special  titles
-specialTitle = ['Dr.', 'The Honorable', 'Col.', 'Cmsgt. Ret.', 'Rev. Mr.', 'Deacon', 'Judge', 
+specialTitle = frozenset(['Dr.', 'The Honorable', 'Col.', 'Cmsgt. Ret.', 'Rev. Mr.', 'Deacon', 'Judge', 
                 'Lt. Col.', 'Col. Ret.', 'Major', 'Capt.', 'Maj. Gen.', 'Family of', 'Senator', 'Reverend', 
                 'Lt.', 'Cmdr.', 'Msgt.', 'Sister', 'Drs.', 'Master', 'Sgt. Maj.', 'SMSgt.', 'Prof.', 'Lt. Col. Ret.', 'Rev. Dr.', 
                 'Father', 'Brother', 'Bishop', 'Gen.', 'Admiral', 'Very Reverend', 'MMC', 'Monsignor', '1st Lt.', 'Reverend Monsignor', 
-                'Maj.', 'Most Reverend', 'Bishop Emeritus','Family of']
+                'Maj.', 'Most Reverend', 'Bishop Emeritus','Family of'])
 
 # List of common titles
-commonTitles = ['Mrs.', 'Mr.', 'Ms.', 'Miss','Sr.','Sra.', 'Señor'] 
+commonTitles = frozenset(['Mrs.', 'Mr.', 'Ms.', 'Miss','Sr.','Sra.', 'Señor'])
+
+# Small title groups used by the blank title fills
+female_common_titles = frozenset(['Mrs.', 'Ms.', 'Miss'])
+unmarried_female_titles = frozenset(['Ms.', 'Miss'])
+
+main_fields = ['CnBio_Gender', 'CnBio_First_Name', 'CnBio_Last_Name', 'CnBio_Title_1']
+spouse_fields = ['CnSpSpBio_Gender', 'CnSpSpBio_First_Name', 'CnSpSpBio_Last_Name', 'CnSpSpBio_Title_1']
+
+
+def _blank(column):
+    # True where the value is missing or only whitespace
+    return column.isna() | (column.str.strip() == '')
+
+
+def _is_yes(column):
+    # Yes/No flags are nullable booleans once the label schema is applied
+    if column.dtype == 'boolean':
+        return column.fillna(False).astype(bool)
+    return column == 'Yes'
+
+
+def _same_last_name(df):
+    # Missing last names never match, same as comparing NaN row by row
+    return df['CnBio_Last_Name'] == df['CnSpSpBio_Last_Name']
+
+
+# Label rules. Each rule works on whole columns: it builds a boolean mask of the rows it
+# matches from the current state of the frame, updates those rows in place and returns
+# the mask. The rules run in the order of LABEL_RULES, so every rule sees the result of
+# the ones before it exactly like the old row by row df.apply passes did.
+
+def remove_data_based_on_condition1(df):
+    # Check if 'CnBio_First_Name' is equal to 'CnSpSpBio_First_Name' and remove data if True
+    mask = df['CnBio_First_Name'] == df['CnSpSpBio_First_Name']
+    df.loc[mask, ['CnSpSpBio_Gender', 'CnSpSpBio_Title_1', 'CnSpSpBio_First_Name', 'CnSpSpBio_Last_Name']] = None
+    df.loc[mask, 'CnBio_Marital_status'] = 'WidSinDiv_0'
+    return mask
+
+def remove_data_based_on_condition2(df):
+    # Check if 'CnSpSpBio_Inactive' or 'CnSpSpBio_Deceased' is 'Yes' and remove data if True
+    mask = (_is_yes(df['CnSpSpBio_Inactive']) | _is_yes(df['CnSpSpBio_Deceased']) |
+            df['CnBio_Marital_status'].isin(['Widowed', 'Divorced', 'Separated', 'Annuled']))
+    df.loc[mask, ['CnSpSpBio_Gender', 'CnSpSpBio_Title_1', 'CnSpSpBio_First_Name', 'CnSpSpBio_Last_Name']] = None
+    df.loc[mask, 'CnBio_Marital_status'] = 'WidSinDiv_0'
+    return mask
+
+def swap_rows_based_on_gender(df):
+    mask = (df['CnBio_Gender'] == 'Female') & (df['CnSpSpBio_Gender'] == 'Male')
+    main_values = df.loc[mask, main_fields].to_numpy()
+    df.loc[mask, main_fields] = df.loc[mask, spouse_fields].to_numpy()
+    df.loc[mask, spouse_fields] = main_values
+    return mask
+
+def update_titles_if_married(df):
+    # This function update Ms and Miss to mrs if the last names are the same and marital status is married 
+    mask = (_same_last_name(df) &
+            ((df['CnBio_Marital_status'] == 'Married') | (df['CnSpSpBio_Marital_status'] == 'Married')) &
+            (df['CnBio_Title_1'] != 'Mr.') &
+            (df['CnSpSpBio_Title_1'].isin(unmarried_female_titles) | df['CnBio_Title_1'].isin(unmarried_female_titles)))
+    df.loc[mask, ['CnSpSpBio_Title_1', 'CnBio_Title_1']] = 'Mrs.'
+    return mask
+
+def update_titles_if_blank_mr(df):
+    # This function update blanks titles to mr if gender is male or sptitle is mrs, ms, or miss
+    mask = (df['CnBio_Title_1'].isna() & df['CnBio_Last_Name'].notna() &
+            ((df['CnBio_Gender'] == 'Male') | df['CnSpSpBio_Title_1'].isin(female_common_titles)))
+    df.loc[mask, 'CnBio_Title_1'] = 'Mr.'
+    return mask
+
+def update_titles_if_blank_ms(df):
+    # This function updates blank titles to ms if gender is female or sptitle Mr.
+    mask = (df['CnBio_Title_1'].isna() & df['CnBio_Last_Name'].notna() &
+            ((df['CnBio_Gender'] == 'Female') | (df['CnSpSpBio_Title_1'] == 'Mr.')))
+    df.loc[mask, 'CnBio_Title_1'] = 'Ms.'
+    return mask
+
+def update_sptitles_if_blank_mr(df):
+    # This function updates blank sptitles to mr if gender is male or title is mrs, ms, or miss
+    mask = (df['CnSpSpBio_Title_1'].isna() & df['CnSpSpBio_Last_Name'].notna() &
+            ((df['CnSpSpBio_Gender'] == 'Male') | df['CnBio_Title_1'].isin(female_common_titles)))
+    df.loc[mask, 'CnSpSpBio_Title_1'] = 'Mr.'
+    return mask
+
+def update_sptitles_if_blank_ms(df):
+    # This function updates blanks sptitles to ms if gender is female or title is mr
+    mask = (df['CnSpSpBio_Title_1'].isna() & df['CnSpSpBio_Last_Name'].notna() &
+            ((df['CnSpSpBio_Gender'] == 'Female') | (df['CnBio_Title_1'] == 'Mr.')))
+    df.loc[mask, 'CnSpSpBio_Title_1'] = 'Ms.'
+    return mask
+
+def update_marital_status_if_blank_married(df):
+    # If marital status is blank and Last names are  equal, fill in with married. They might be brother and sister, but Add/sal will be mostly the same. 
+    status = df['CnBio_Marital_status']
+    mask = (((status.isna() | (status == 'Single')) & _same_last_name(df)) |
+            ((df['CnSpSpBio_Last_Name'] != df['CnBio_Last_Name']) & df['CnSpSpBio_Last_Name'].notna()))
+    df.loc[mask, 'CnBio_Marital_status'] = 'Married'
+    return mask
+
+def update_marital_status_Widowed(df):
+    # updates marital status to Widowed if Deceased or Inactive = yes. it will also change instnaces where person is married to themselves (wrong status but avoids bad add/sal) 
+    # Check if spouse-related fields are all blank
+    spouse_info_blank = _blank(df['CnSpSpBio_Title_1']) & _blank(df['CnSpSpBio_First_Name']) & _blank(df['CnSpSpBio_Last_Name'])
+    status = df['CnBio_Marital_status']
+    # Update marital status to 'Widowed' based on specified conditions
+    mask = (_is_yes(df['CnSpSpBio_Deceased']) |
+            _is_yes(df['CnSpSpBio_Inactive']) |
+            status.isin(['Divorced', 'Separated']) |
+            ((status.isin(['Single', 'Married', 'Unknown']) | status.isna()) & spouse_info_blank))
+    df.loc[mask, 'CnBio_Marital_status'] = 'WidSinDiv_0'
+    return mask
+
+def Different_Last_Name_1(df):
+    # Check if last names are different, marital status is 'Married', 
+    # and either first name or last name of the spouse is not null/blank
+    mask = ((df['CnBio_Last_Name'] != df['CnSpSpBio_Last_Name']) &
+            (df['CnBio_Marital_status'] == 'Married') &
+            (~_blank(df['CnSpSpBio_First_Name']) | ~_blank(df['CnSpSpBio_Last_Name'])))
+    df.loc[mask, 'CnBio_Marital_status'] = 'DifferentLastName_1'
+    return mask
+
+def Same_Last_Name_Same_Title_NonSpecial_2(df):
+    # If last names are different but titles are the same and neither are special
+    mask = (_same_last_name(df) & (df['CnBio_Title_1'] == df['CnSpSpBio_Title_1']) &
+            (df['CnBio_Marital_status'] == 'Married') & ~df['CnBio_Title_1'].isin(specialTitle))
+    df.loc[mask, 'CnBio_Marital_status'] = 'SameLastNameSameTitleNonSpecial_2'
+    return mask
+
+def Same_Last_Name_Same_Title_Special_3(df):
+    # If Last names are the same and the title is the same 
+    mask = (_same_last_name(df) & (df['CnBio_Marital_status'] == 'Married') &
+            (df['CnBio_Title_1'] == df['CnSpSpBio_Title_1']) & df['CnBio_Title_1'].isin(specialTitle))
+    df.loc[mask, 'CnBio_Marital_status'] = 'SameLastNameSameTitleSpecial_3'
+    return mask
+
+def Same_Last_Name_Both_Specical_Title_4(df):
+    # If Last names are the same and both have a special title
+    mask = (_same_last_name(df) & (df['CnBio_Marital_status'] == 'Married') &
+            df['CnBio_Title_1'].isin(specialTitle) & df['CnSpSpBio_Title_1'].isin(specialTitle))
+    df.loc[mask, 'CnBio_Marital_status'] = 'SameLastNameBothSpecicalTitle_4'
+    return mask
+
+def Same_Last_Name_Main_Specical_Title_5(df):
+    # If Last names are the same only main has special title
+    mask = _same_last_name(df) & (df['CnBio_Marital_status'] == 'Married') & df['CnBio_Title_1'].isin(specialTitle)
+    df.loc[mask, 'CnBio_Marital_status'] = 'SameLastNameMainSpecicalTitle_5'
+    return mask
+
+def Same_Last_Name_Sp_Specical_Title_6(df):
+    # If Last names are the same only spouse has special title
+    mask = _same_last_name(df) & (df['CnBio_Marital_status'] == 'Married') & df['CnSpSpBio_Title_1'].isin(specialTitle)
+    df.loc[mask, 'CnBio_Marital_status'] = 'SameLastNameSpSpecicalTitle_6'
+    return mask
+
+def Standard_Add_Sal_7(df):
+    # Standard Add/sal for married couple
+    mask = (_same_last_name(df) & (df['CnBio_Marital_status'] != 'Widowed') &
+            (df['CnBio_Marital_status'] == 'Married') &
+            (df['CnBio_Title_1'].isin(commonTitles) | df['CnSpSpBio_Title_1'].isin(commonTitles)))
+    df.loc[mask, 'CnBio_Marital_status'] = 'StandardAddSal_7'
+    return mask
+
+def Standard_Add_Sal_MaleSp_8(df):
+    mask = (_same_last_name(df) & (df['CnBio_Marital_status'] != 'Widowed') &
+            (df['CnBio_Marital_status'] == 'Married') &
+            (df['CnBio_Title_1'].isin(commonTitles) | df['CnSpSpBio_Title_1'].isin(commonTitles)) &
+            (df['CnSpSpBio_Gender'] == 'Male'))
+    df.loc[mask, 'CnBio_Marital_status'] = 'StandardAddSal_MaleSp_8'
+    return mask
+
+def blank_names_Unchanged_AddSal(df):
+    # Name info is blank, cannot concatenate a addsal
+    mask = df['CnBio_Last_Name'].isna() & df['CnBio_First_Name'].isna()
+    df.loc[mask, 'CnBio_Marital_status'] = 'Unchanged'
+    return mask
+
+# Columns the label rules write, compared before and after each rule when it is measured
+RULE_COLUMNS = main_fields + spouse_fields + ['CnBio_Marital_status']
+
+def count_changed_rows(before, after):
+    """Rows where any column of after differs from before, blanks on both sides being equal."""
+    changed = np.zeros(len(before), dtype=bool)
+    for col in before.columns:
+        old, new = before[col], after[col]
+        same = (old == new).to_numpy(dtype=bool, na_value=False) | (old.isna() & new.isna()).to_numpy()
+        changed |= ~same
+    return int(changed.sum())
+
+# Order matters, later rules only see 'Married' rows the earlier ones left alone
+LABEL_RULES = [
+    remove_data_based_on_condition1,
+    remove_data_based_on_condition2,
+    swap_rows_based_on_gender,
+    update_titles_if_married,
+    update_titles_if_blank_mr,
+    update_titles_if_blank_ms,
+    update_sptitles_if_blank_mr,
+    update_sptitles_if_blank_ms,
+    update_marital_status_if_blank_married,
+    update_marital_status_Widowed,
+    Different_Last_Name_1,
+    Same_Last_Name_Same_Title_NonSpecial_2,
+    Same_Last_Name_Same_Title_Special_3,
+    Same_Last_Name_Both_Specical_Title_4,
+    Same_Last_Name_Main_Specical_Title_5,
+    Same_Last_Name_Sp_Specical_Title_6,
+    Standard_Add_Sal_7,
+    Standard_Add_Sal_MaleSp_8,
+    blank_names_Unchanged_AddSal,
+]
+
+def apply_label_rules(df, cancel=None, recorder=None):
+    """Run every label rule over the frame in order, updating it in place.
+
+    cancel is checked between rule passes, see progress.check_cancelled. With a
+    timings.Recorder each rule is measured along with the rows it changed.
+    """
+    for rule in LABEL_RULES:
+        check_cancelled(cancel)
+        # Matched rows can already hold the values a rule writes, so only real changes count
+        before = None if recorder is None else df[RULE_COLUMNS].copy()
+        with measure(recorder, rule.__name__, RULE, len(df)) as span:
+            rule(df)
+        if before is not None:
+            span.changed = count_changed_rows(before, df[RULE_COLUMNS])
+    return df
+
+# Addressee and salutation templates for each marital status code set by the label rules.
+# Any code that is not listed here gets a blank add/sal, which helps find edge cases.
+ADD_SAL_TEMPLATES = {
+    # Not enough data to concatenate a add/sal
+    'Unchanged': ('{CnAdrSal_Addressee}',
+                  '{CnAdrSal_Salutation}'),
+    # Mr. Bryce Howard
+    # Mr. Howard
+    'WidSinDiv_0': ('{CnBio_Title_1} {CnBio_First_Name} {CnBio_Last_Name}',
+                    '{CnBio_Title_1} {CnBio_Last_Name}'),
+    # Mr. Bryce Howard and Mrs. Jennifer Ha
+    # Mr. Howard and Mrs. Ha
+    'DifferentLastName_1': ('{CnBio_Title_1} {CnBio_First_Name} {CnBio_Last_Name} and {CnSpSpBio_Title_1} {CnSpSpBio_First_Name} {CnSpSpBio_Last_Name}',
+                            '{CnBio_Title_1} {CnBio_Last_Name} and {CnSpSpBio_Title_1} {CnSpSpBio_Last_Name}'),
+    # Mr. Bryce Howard and Mr. Branden Howard
+    # Mr and Mr. Howard
+    'SameLastNameSameTitleNonSpecial_2': ('{CnBio_Title_1} {CnBio_First_Name} {CnBio_Last_Name} and {CnSpSpBio_Title_1} {CnSpSpBio_First_Name} {CnSpSpBio_Last_Name}',
+                                          '{CnBio_Title_1} and {CnSpSpBio_Title_1} {CnBio_Last_Name}'),
+    # Dr. Bryce Howard and Dr. Jen Howard
+    # Dr. Howard and Dr. Howard
+    'SameLastNameSameTitleSpecial_3': ('{CnBio_Title_1} {CnBio_First_Name} {CnBio_Last_Name} and {CnSpSpBio_Title_1} {CnSpSpBio_First_Name} {CnSpSpBio_Last_Name}',
+                                       '{CnBio_Title_1} {CnBio_Last_Name} and {CnSpSpBio_Title_1} {CnSpSpBio_Last_Name}'),
+    # Senator Bryce Howard and Dr. Jen Howard
+    # Senator Howard and Dr. Howard
+    'SameLastNameBothSpecicalTitle_4': ('{CnBio_Title_1} {CnBio_First_Name} {CnBio_Last_Name} and {CnSpSpBio_Title_1} {CnSpSpBio_First_Name} {CnSpSpBio_Last_Name}',
+                                        '{CnBio_Title_1} {CnBio_Last_Name} and {CnSpSpBio_Title_1} {CnSpSpBio_Last_Name}'),
+    # Dr. Bryce Howard and Mrs. Howard
+    # Dr. Howard and Mrs. Howard
+    'SameLastNameMainSpecicalTitle_5': ('{CnBio_Title_1} {CnBio_First_Name} {CnBio_Last_Name} and {CnSpSpBio_Title_1} {CnSpSpBio_Last_Name}',
+                                        '{CnBio_Title_1} {CnBio_Last_Name} and {CnSpSpBio_Title_1} {CnSpSpBio_Last_Name}'),
+    # Dr. Jennifer Howard and Mr. Bryce Howard
+    # Dr. Howard and Mr. Howard
+    'SameLastNameSpSpecicalTitle_6': ('{CnSpSpBio_Title_1} {CnSpSpBio_First_Name} {CnSpSpBio_Last_Name} and {CnBio_Title_1} {CnBio_Last_Name}',
+                                      '{CnSpSpBio_Title_1} {CnSpSpBio_Last_Name} and {CnBio_Title_1} {CnBio_Last_Name}'),
+    # Mr. and Mrs. Bryce Howard
+    # Mr. and Mrs. Howard
+    'StandardAddSal_7': ('{CnBio_Title_1} and {CnSpSpBio_Title_1} {CnBio_First_Name} {CnBio_Last_Name}',
+                         '{CnBio_Title_1} and {CnSpSpBio_Title_1} {CnBio_Last_Name}'),
+    # Mr. and Mrs. Jennifer Howard
+    # Mr. and Mrs. Howard
+    'StandardAddSal_MaleSp_8': ('{CnSpSpBio_Title_1} and {CnBio_Title_1} {CnSpSpBio_First_Name} {CnSpSpBio_Last_Name}',
+                                '{CnSpSpBio_Title_1} and {CnBio_Title_1} {CnSpSpBio_Last_Name}'),
+}
+
+# WidSinDiv_0 rows without a last name are addressed by first name
+WIDSINDIV_FIRST_NAME_TEMPLATES = ('{CnBio_Title_1} {CnBio_First_Name}',
+                                  '{CnBio_Title_1} {CnBio_First_Name}')
+
+
+def render_template(df, template):
+    """Render a '{column}' format template for every row of df at once."""
+    rendered = pd.Series('', index=df.index, dtype=object)
+    for literal, field, _, _ in string.Formatter().parse(template):
+        if literal:
+            rendered = rendered + literal
+        if field is not None:
+            rendered = rendered + df[field].fillna('').astype(str).astype(object)
+    return rendered
+
+def concate_add_sal(df):
+    """Build CnAdrSal_Addressee and CnAdrSal_Salutation from ADD_SAL_TEMPLATES, one category at a time."""
+    status = df['CnBio_Marital_status']
+    addressee = pd.Series('', index=df.index, dtype=object)
+    salutation = pd.Series('', index=df.index, dtype=object)
+
+    has_last_name = ~_blank(df['CnBio_Last_Name'])
+    has_first_name = ~_blank(df['CnBio_First_Name'])
+    masks = {code: status == code for code in ADD_SAL_TEMPLATES}
+    widowed = masks['WidSinDiv_0']
+    masks['WidSinDiv_0'] = widowed & has_last_name
+    categories = [(masks[code], ADD_SAL_TEMPLATES[code]) for code in ADD_SAL_TEMPLATES]
+    categories.append((widowed & ~has_last_name & has_first_name, WIDSINDIV_FIRST_NAME_TEMPLATES))
+
+    for mask, (addressee_template, salutation_template) in categories:
+        if not mask.any():
+            continue
+        rows = df.loc[mask]
+        addressee[mask] = render_template(rows, addressee_template)
+        salutation[mask] = render_template(rows, salutation_template)
+
+    df['CnAdrSal_Addressee'] = addressee
+    df['CnAdrSal_Salutation'] = salutation
+    return df
+
+# Title/gender checks run before cleaning: (rule, gender column, title column, gender, titles).
+# 'Unknown' gender rules only apply when the matching first name is not empty.
+TITLE_GENDER_RULES = [
+    ('Male with female title', 'CnBio_Gender', 'CnBio_Title_1', 'Male', strictly_female_titles),
+    ('Female with male title', 'CnBio_Gender', 'CnBio_Title_1', 'Female', strictly_male_titles),
+    ('Male with female title', 'CnSpSpBio_Gender', 'CnSpSpBio_Title_1', 'Male', strictly_female_titles),
+    ('Female with male title', 'CnSpSpBio_Gender', 'CnSpSpBio_Title_1', 'Female', strictly_male_titles),
+    ('Unknown gender with gendered title', 'CnBio_Gender', 'CnBio_Title_1', 'Unknown', strictly_male_titles | strictly_female_titles),
+    ('Unknown gender with gendered title', 'CnSpSpBio_Gender', 'CnSpSpBio_Title_1', 'Unknown', strictly_male_titles | strictly_female_titles),
+]
+title_gender_report_columns = ['CnBio_ID', 'CnBio_Gender', 'CnBio_Title_1', 'CnSpSpBio_Gender', 'CnSpSpBio_Title_1']
+title_gender_columns = title_gender_report_columns + ['CnBio_First_Name', 'CnSpSpBio_First_Name']
+
+def find_title_gender_errors(df):
+    """Return one row per TITLE_GENDER_RULES violation with the rule, the columns involved and the record."""
+    errors = []
+    for order, (rule, gender_column, title_column, gender, titles) in enumerate(TITLE_GENDER_RULES):
+        mask = (df[gender_column] == gender) & df[title_column].isin(titles)
+        if gender == 'Unknown':
+            first_name_column = gender_column.replace('_Gender', '_First_Name')
+            mask &= df[first_name_column] != ''
+        if not mask.any():
+            continue
+        found = df.loc[mask, title_gender_report_columns].copy()
+        found.insert(0, 'Columns', f"{gender_column}, {title_column}")
+        found.insert(0, 'Rule', rule)
+        found['_row'] = mask.to_numpy().nonzero()[0]
+        found['_order'] = order
+        errors.append(found)
+
+    if not errors:
+        return pd.DataFrame(columns=['Rule', 'Columns'] + title_gender_report_columns)
+    # Same order as reading the file top to bottom
+    errors = pd.concat(errors).sort_values(['_row', '_order'], kind='stable')
+    return errors.drop(columns=['_row', '_order']).reset_index(drop=True)
+
+# Column position of Bishop_Addressee in the _export_clean.csv, Bishop_Salutation follows it
+BISHOP_FIELDS_POSITION = 12
+
+def add_bishop_fields(df):
+    """Insert first name based Bishop_Addressee and Bishop_Salutation columns in place."""
+    first_name = df['CnBio_First_Name'].fillna('').astype(object)
+    last_name = df['CnBio_Last_Name'].fillna('').astype(object)
+    spouse_first_name = df['CnSpSpBio_First_Name'].fillna('').astype(object)
+    has_spouse = spouse_first_name != ''
+    no_name = df['CnBio_First_Name'].isna() & df['CnBio_Last_Name'].isna()
+
+    # John and Jane Smith / John and Jane, or John Smith / John without a spouse
+    addressee = (first_name + ' and ' + spouse_first_name + ' ' + last_name).where(has_spouse, first_name + ' ' + last_name)
+    salutation = (first_name + ' and ' + spouse_first_name).where(has_spouse, first_name)
+    addressee[no_name] = ''
+    salutation[no_name] = ''
+
+    position = min(BISHOP_FIELDS_POSITION, len(df.columns))
+    df.insert(position, 'Bishop_Addressee', addressee)
+    df.insert(position + 1, 'Bishop_Salutation', salutation)
+    return df
+
+def update_add_sal_request(df):
+    """Use the first 'Add/Sal Request' note of each record as its addressee and salutation."""
+    # Note columns come in <note>_Type / <note>_Description pairs
+    note_types = [col for col in df.columns if '_Type' in col and col.replace('_Type', '_Description') in df.columns]
+    if not note_types:
+        return df
+    note_descriptions = [col.replace('_Type', '_Description') for col in note_types]
+
+    # One row per record, one column per note, True where the note is a request
+    requests = (df[note_types] == 'Add/Sal Request').to_numpy()
+    has_request = requests.any(axis=1)
+    if not has_request.any():
+        return df
+
+    # argmax picks the first matching note column for each record
+    first_request = requests[has_request].argmax(axis=1)
+    descriptions = df.loc[has_request, note_descriptions].to_numpy()[np.arange(len(first_request)), first_request]
+    df.loc[has_request, 'CnAdrSal_Addressee'] = descriptions
+    df.loc[has_request, 'CnAdrSal_Salutation'] = descriptions
+    df.loc[has_request, 'CnBio_Marital_status'] = 'Add/Sal Request'
+    return df
+
+# Label schema. Low-cardinality columns are loaded as categoricals so the rules compare
+# category codes instead of Python strings. Columns in one group share a category set,
+# which lets the rules compare and swap them, and the extra values are the ones the
+# rules and the blank fills can write on top of what the export holds.
+CATEGORY_GROUPS = [
+    (['CnBio_Gender', 'CnSpSpBio_Gender'], []),
+    (['CnBio_Title_1', 'CnSpSpBio_Title_1'], sorted(AllREtitles) + ['']),
+    (['CnBio_Marital_status'], ['Married', 'WidSinDiv_0', 'DifferentLastName_1', 'SameLastNameSameTitleNonSpecial_2',
+                                'SameLastNameSameTitleSpecial_3', 'SameLastNameBothSpecicalTitle_4',
+                                'SameLastNameMainSpecicalTitle_5', 'SameLastNameSpSpecicalTitle_6', 'StandardAddSal_7',
+                                'StandardAddSal_MaleSp_8', 'Unchanged', 'Add/Sal Request']),
+    (['CnSpSpBio_Marital_status'], []),
+]
+
+# Yes/No columns loaded as nullable booleans
+FLAG_COLUMNS = ['CnSpSpBio_Inactive', 'CnSpSpBio_Deceased']
+flag_values = {'Yes': True, 'No': False}
+
+def apply_label_schema(df):
+    """Convert the low-cardinality label columns of df to categoricals and booleans in place."""
+    for columns, extra_values in CATEGORY_GROUPS:
+        columns = [col for col in columns if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype)]
+        if not columns:
+            continue
+        observed = pd.unique(pd.concat([df[col].dropna() for col in columns]))
+        categories = pd.Index(observed).union(pd.Index(extra_values, dtype=observed.dtype), sort=False)
+        for col in columns:
+            df[col] = pd.Categorical(df[col], categories=categories)
+
+    for col in FLAG_COLUMNS:
+        # Anything besides Yes/No/blank is left as text so it is written back unchanged
+        if col in df.columns and df[col].dtype != 'boolean' and df[col].dropna().isin(flag_values).all():
+            df[col] = df[col].map(flag_values).astype('boolean')
+    return df
+
+def restore_flag_columns(df):
+    """Turn boolean flag columns back into the Yes/No text of the export."""
+    for col in FLAG_COLUMNS:
+        if col in df.columns and df[col].dtype == 'boolean':
+            df[col] = df[col].map({True: 'Yes', False: 'No'}, na_action='ignore')
+    return df
+
+def clean_labels(df, cancel=None, recorder=None):
+    """Run the label rules and build the add/sal and Bishop columns, updating df in place."""
+    with measure(recorder, 'clean labels', STEP, len(df)):
+        return _clean_labels(df, cancel, recorder)
+
+def _clean_labels(df, cancel, recorder):
+    apply_label_schema(df)
+    apply_label_rules(df, cancel, recorder)
+    check_cancelled(cancel)
+
+    # fills back in a blank space otherwise it would fill cell with 'nan'
+    df['CnBio_First_Name'] = df['CnBio_First_Name'].loc[:].fillna('')
+    df['CnBio_Last_Name'] = df['CnBio_Last_Name'].loc[:].fillna('')
+    df['CnSpSpBio_First_Name'] = df['CnSpSpBio_First_Name'].loc[:].fillna('')
+    df['CnSpSpBio_Last_Name'] = df['CnSpSpBio_Last_Name'].loc[:].fillna('')
+    df['CnBio_Title_1'] = df['CnBio_Title_1'].loc[:].fillna('')
+    df['CnSpSpBio_Title_1'] = df['CnSpSpBio_Title_1'].loc[:].fillna('')
+
+    with measure(recorder, 'concate_add_sal', STEP, len(df)):
+        concate_add_sal(df)
+
+    with measure(recorder, 'add_bishop_fields', STEP, len(df)):
+        add_bishop_fields(df)
+
+    # check notes for add/sal requests
+    with measure(recorder, 'update_add_sal_request', STEP, len(df)):
+        update_add_sal_request(df)
+    restore_flag_columns(df)
+    return df
+
+def clean_partition(df, memory=False):
+    """clean_labels for a pool process, returning the frame and the spans it recorded."""
+    recorder = Recorder(memory)
+    return clean_labels(df, recorder=recorder), recorder.spans
+
+# Rough ratio between a chunk's loaded size and the peak memory used while cleaning it
+# (masks, rendered add/sal strings and the to_csv buffer)
+CHUNK_MEMORY_FACTOR = 4
+
+# Files with more rows than this are split into row partitions for the process pool
+PARTITION_ROWS = 50000
+
+def split_rows(df, rows):
+    """Split df into consecutive partitions of at most rows rows."""
+    if len(df) <= rows:
+        return [df]
+    return [df.iloc[start:start + rows].copy() for start in range(0, len(df), rows)]
+
+# Partitions submitted to the pool per worker before the oldest result is waited for
+PARTITIONS_PER_WORKER = 2
+
+def partitions_in_flight(workers=None):
+    """Most partitions map_partitions holds in memory at once with this many workers."""
+    workers = workers or os.cpu_count() or 1
+    return 1 if workers <= 1 else workers * PARTITIONS_PER_WORKER
+
+def map_partitions(func, partitions, workers=None):
+    """Yield func(partition) for each partition in order, running them on a process pool.
+
+    At most PARTITIONS_PER_WORKER partitions per worker are in flight, so partitions
+    coming from a chunked reader are never all held in memory at once.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        for partition in partitions:
+            yield func(partition)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for partition in partitions:
+                pending.append(executor.submit(func, partition))
+                if len(pending) >= workers * PARTITIONS_PER_WORKER:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # The caller stopped early (e.g. cancelled), don't start the partitions still queued
+            for future in pending:
+                future.cancel()
 
 class LabelProcessor:
-    def __init__(self, input_dir):
+    def __init__(self, input_dir, chunk_size=None, max_memory_mb=None, workers=None, cancel=None, recorder=None):
+        """chunk_size (rows) or max_memory_mb turn on streaming mode for large exports.
+
+        workers is the size of the process pool used for row partitions, all cores by default.
+        cancel is a threading.Event checked between files, partitions, chunks and, when
+        cleaning runs in this process, rule passes. Setting it raises progress.Cancelled.
+
+        recorder is a timings.Recorder that gets the loads, checks, rules and writes,
+        including the ones run in pool processes.
+        """
         self.input_dir = input_dir
-    
+        self.chunk_size = chunk_size
+        self.max_memory_mb = max_memory_mb
+        self.workers = workers
+        self.cancel = cancel
+        self.recorder = recorder
+
+    @property
+    def streaming(self):
+        return bool(self.chunk_size or self.max_memory_mb)
+
+    def clean_partitions(self, partitions, workers):
+        """Yield each partition cleaned by clean_labels, in order, see map_partitions.
+
+        An Event can't be sent to pool processes, so rule passes only check cancel when
+        cleaning runs in this process. Pool processes send their spans back instead.
+        """
+        if (workers or os.cpu_count() or 1) <= 1:
+            return map_partitions(partial(clean_labels, cancel=self.cancel, recorder=self.recorder), partitions, 1)
+        if self.recorder is None:
+            return map_partitions(clean_labels, partitions, workers)
+        return self.recorder.collect(map_partitions(partial(clean_partition, memory=self.recorder.memory), partitions, workers))
+
     def process_files(self):
+        """Check and clean every *_export.csv in the input folder.
+
+        Each file is handled on its own: a file that fails the title/gender check is
+        reported and skipped, the others are still cleaned. Returns False if any file failed.
+        """
         files = glob.glob(os.path.join(self.input_dir, '*_export.CSV')) + glob.glob(os.path.join(self.input_dir, '*_export.csv'))
+        all_valid = True
+        jobs = []
         for file in files:
-            try:
-                df = pd.read_csv(file, encoding='utf-8', low_memory=False, dtype=str)
-                file_encoding = 'utf-8'
-            except UnicodeDecodeError:
-                df = pd.read_csv(file, encoding='ISO-8859-1', low_memory=False, dtype=str)
-                file_encoding = 'ISO-8859-1'
-
-            if not self.check_titles_and_genders(df):
-                print("ERROR:")
-                return False
-        
-        def remove_data_based_on_condition1(row):
-            # Check if 'CnBio_First_Name' is equal to 'CnSpSpBio_First_Name' and remove data if True
-            if row['CnBio_First_Name'] == row['CnSpSpBio_First_Name']:
-                row['CnSpSpBio_Gender'] = None
-                row['CnSpSpBio_Title_1'] = None
-                row['CnSpSpBio_First_Name'] = None
-                row['CnSpSpBio_Last_Name'] = None
-                row['CnBio_Marital_status'] = 'WidSinDiv_0'
-
-            return row
-        df = df.apply(remove_data_based_on_condition1, axis=1)
-    
-        def remove_data_based_on_condition2(row):
-            # Check if 'CnSpSpBio_Inactive' or 'CnSpSpBio_Deceased' is 'Yes' and remove data if True
-            if row['CnSpSpBio_Inactive'] == 'Yes' or row['CnSpSpBio_Deceased'] == 'Yes' or row['CnBio_Marital_status'] == 'Widowed' or row['CnBio_Marital_status'] == 'Divorced' or row['CnBio_Marital_status'] == 'Separated'or row['CnBio_Marital_status'] == 'Annuled':
-                row['CnSpSpBio_Gender'] = None
-                row['CnSpSpBio_Title_1'] = None
-                row['CnSpSpBio_First_Name'] = None
-                row['CnSpSpBio_Last_Name'] = None
-                row['CnBio_Marital_status'] = 'WidSinDiv_0'
-
-            return row
-        df = df.apply(remove_data_based_on_condition2, axis=1)
-
-        def swap_rows_based_on_gender(row):
-            if row['CnBio_Gender'] == 'Female' and row['CnSpSpBio_Gender'] == 'Male':
-                temp_gender = row['CnBio_Gender']
-                temp_first_name = row['CnBio_First_Name']
-                temp_last_name = row['CnBio_Last_Name']
-                temp_title = row['CnBio_Title_1']
-
-                row['CnBio_Gender'] = row['CnSpSpBio_Gender']
-                row['CnBio_First_Name'] = row['CnSpSpBio_First_Name']
-                row['CnBio_Last_Name'] = row['CnSpSpBio_Last_Name']
-                row['CnBio_Title_1'] = row['CnSpSpBio_Title_1']
-
-                row['CnSpSpBio_Gender'] = temp_gender
-                row['CnSpSpBio_First_Name'] = temp_first_name
-                row['CnSpSpBio_Last_Name'] = temp_last_name
-                row['CnSpSpBio_Title_1'] = temp_title
-            return row
-        df = df.apply(swap_rows_based_on_gender, axis=1)
-        
-        def update_titles_if_married(row):
-        # This function update Ms and Miss to mrs if the last names are the same and marital status is married 
-            if (row['CnBio_Last_Name'] == row['CnSpSpBio_Last_Name']) and (row['CnBio_Marital_status'] == 'Married' or row['CnSpSpBio_Marital_status'] == 'Married') and (row['CnBio_Title_1'] != 'Mr.') and (row['CnSpSpBio_Title_1'] == 'Miss' 
-            or row['CnSpSpBio_Title_1'] == 'Ms.' or row['CnBio_Title_1'] == 'Miss' or row['CnBio_Title_1'] == 'Ms.'):
-                row['CnSpSpBio_Title_1'] = 'Mrs.'
-                row['CnBio_Title_1'] = 'Mrs.'
-            return row
-        df = df.apply(update_titles_if_married, axis=1)
-
-        def update_titles_if_blank_mr(row):
-        # This function update blanks titles to mr if gender is male or sptitle is mrs, ms, or miss
-            if (pd.isnull(row['CnBio_Title_1']) and pd.notnull(row['CnBio_Last_Name']) and (row['CnBio_Gender'] == 'Male' or row['CnSpSpBio_Title_1'] == 'Mrs.' or row['CnSpSpBio_Title_1'] == 'Ms.' or row['CnSpSpBio_Title_1'] == 'Miss')):
-                row['CnBio_Title_1'] = 'Mr.'
-            return row
-        df = df.apply(update_titles_if_blank_mr, axis=1)
-
-        def update_titles_if_blank_ms(row):
-        # This function updates blank titles to ms if gender is female or sptitle Mr.
-            if (pd.isnull(row['CnBio_Title_1']) and pd.notnull(row['CnBio_Last_Name']) and (row['CnBio_Gender'] == 'Female' or row['CnSpSpBio_Title_1'] == 'Mr.')):
-                row['CnBio_Title_1'] = 'Ms.'
-            return row
-        df = df.apply(update_titles_if_blank_ms, axis=1)
-
-        def update_sptitles_if_blank_mr(row):
-        # This function updates blank sptitles to mr if gender is male or title is mrs, ms, or miss
-            if (pd.isnull(row['CnSpSpBio_Title_1']) and pd.notnull(row['CnSpSpBio_Last_Name']) and (row['CnSpSpBio_Gender'] == 'Male' or row['CnBio_Title_1'] == 'Mrs.' or row['CnBio_Title_1'] == 'Ms.' or row['CnBio_Title_1'] == 'Miss')):
-                row['CnSpSpBio_Title_1'] = 'Mr.'
-            return row
-        df = df.apply(update_sptitles_if_blank_mr, axis=1)
-
-        def update_sptitles_if_blank_ms(row):
-        # This function updates blanks sptitles to ms if gender is female or title is mr
-            if (pd.isnull(row['CnSpSpBio_Title_1']) and pd.notnull(row['CnSpSpBio_Last_Name']) and (row['CnSpSpBio_Gender'] == 'Female' or row['CnBio_Title_1'] == 'Mr.')):
-                row['CnSpSpBio_Title_1'] = 'Ms.'
-            return row
-        df = df.apply(update_sptitles_if_blank_ms, axis=1)
-        
-        def update_marital_status_if_blank_married(row):
-        # If marital status is blank and Last names are  equal, fill in with married. They might be brother and sister, but Add/sal will be mostly the same. 
-            if (((pd.isnull(row['CnBio_Marital_status']) or (row['CnBio_Marital_status'] == 'Single')) and (row['CnSpSpBio_Last_Name'] == row['CnBio_Last_Name'])) or ((row['CnSpSpBio_Last_Name'] != row['CnBio_Last_Name']) and pd.notnull(row['CnSpSpBio_Last_Name']) )):
-                row['CnBio_Marital_status'] = 'Married'
-            return row
-        df = df.apply(update_marital_status_if_blank_married, axis=1)
-
-        def update_marital_status_Widowed(row):
-            # updates marital status to Widowed if Deceased or Inactive = yes. it will also change instnaces where person is married to themselves (wrong status but avoids bad add/sal) 
-            # Check if spouse-related fields are all blank
-            spouse_info_blank = all(pd.isnull(row[field] ) or row[field].strip() == '' for field in ['CnSpSpBio_Title_1', 'CnSpSpBio_First_Name', 'CnSpSpBio_Last_Name'])
-            # Update marital status to 'Widowed' based on specified conditions
-            if ((row['CnSpSpBio_Deceased'] == 'Yes') or 
-                (row['CnSpSpBio_Inactive'] == 'Yes') or 
-                (row['CnBio_Marital_status'] == 'Divorced') or 
-                (row['CnBio_Marital_status'] == 'Separated') or
-                ((row['CnBio_Marital_status'] in ['Single', 'Married', 'Unknown', None] or pd.isnull(row['CnBio_Marital_status'])) and spouse_info_blank)):
-                row['CnBio_Marital_status'] = 'WidSinDiv_0'
-            return row
-        df = df.apply(update_marital_status_Widowed, axis=1)
-
-        def Different_Last_Name_1(row):
-            # Check if last names are different, marital status is 'Married', 
-            # and either first name or last name of the spouse is not null/blank
-            if (row['CnBio_Last_Name'] != row['CnSpSpBio_Last_Name']) and \
-            (row['CnBio_Marital_status'] == 'Married') and \
-            ((pd.notnull(row['CnSpSpBio_First_Name']) and row['CnSpSpBio_First_Name'].strip()) or \
-            (pd.notnull(row['CnSpSpBio_Last_Name']) and row['CnSpSpBio_Last_Name'].strip())):
-                row['CnBio_Marital_status'] = 'DifferentLastName_1'
-            return row
-        df = df.apply(Different_Last_Name_1, axis=1)
-
-        def Same_Last_Name_Same_Title_NonSpecial_2(row):
-            # If last names are different but titles are the same and neither are special
-            global specialTitle # uses list of titles, global is used so that it can be accessed inside the functions
-            if ((row['CnBio_Last_Name'] == row['CnSpSpBio_Last_Name']) and (row['CnBio_Title_1'] == row['CnSpSpBio_Title_1']) and (row['CnBio_Marital_status'] == 'Married') and (row['CnBio_Title_1'] not in specialTitle) ): # 
-                row['CnBio_Marital_status'] = 'SameLastNameSameTitleNonSpecial_2'
-            return row
-        df = df.apply(Same_Last_Name_Same_Title_NonSpecial_2, axis=1)
-        
-        def Same_Last_Name_Same_Title_Special_3(row):
-            # If Last names are the same and the title is the same 
-            global specialTitle
-            if ((row['CnBio_Last_Name'] == row['CnSpSpBio_Last_Name']) and (row['CnBio_Marital_status'] == 'Married') and (row['CnBio_Title_1'] == row['CnSpSpBio_Title_1']) and (row['CnBio_Title_1'] in specialTitle) ):
-                row['CnBio_Marital_status'] = 'SameLastNameSameTitleSpecial_3'
-            return row
-        df = df.apply(Same_Last_Name_Same_Title_Special_3, axis=1)
-        
-        def Same_Last_Name_Both_Specical_Title_4(row):
-            # If Last names are the same and both have a special title
-            global specialTitle
-            if ((row['CnBio_Last_Name'] == row['CnSpSpBio_Last_Name']) and (row['CnBio_Marital_status'] == 'Married') and (row['CnBio_Title_1'] in specialTitle and row['CnSpSpBio_Title_1'] in specialTitle) ):
-                row['CnBio_Marital_status'] = 'SameLastNameBothSpecicalTitle_4'
-            return row
-        df = df.apply(Same_Last_Name_Both_Specical_Title_4, axis=1)
-        
-        def Same_Last_Name_Main_Specical_Title_5(row):
-            # If Last names are the same only main has special title
-            global specialTitle
-            if ((row['CnBio_Last_Name'] == row['CnSpSpBio_Last_Name']) and (row['CnBio_Marital_status'] == 'Married') and (row['CnBio_Title_1'] in specialTitle) ):
-                row['CnBio_Marital_status'] = 'SameLastNameMainSpecicalTitle_5'
-            return row
-        df = df.apply(Same_Last_Name_Main_Specical_Title_5, axis=1) 
-        
-        def Same_Last_Name_Sp_Specical_Title_6(row): 
-            # If Last names are the same only spouse has special title
-            global specialTitle
-            if ((row['CnBio_Last_Name'] == row['CnSpSpBio_Last_Name']) and (row['CnBio_Marital_status'] == 'Married') and (row['CnSpSpBio_Title_1'] in specialTitle) ):
-                row['CnBio_Marital_status'] = 'SameLastNameSpSpecicalTitle_6'
-            return row
-        df = df.apply(Same_Last_Name_Sp_Specical_Title_6, axis=1)
-
-        def Standard_Add_Sal_7(row): 
-            # Standard Add/sal for married couple
-            global commonTitles
-            if ((row['CnBio_Last_Name'] == row['CnSpSpBio_Last_Name']) and (row['CnBio_Marital_status'] != 'Widowed') and 
-                (row['CnBio_Marital_status'] == 'Married') and ((row['CnBio_Title_1'] in commonTitles) or (row['CnSpSpBio_Title_1'] in commonTitles)  ) ):
-                row['CnBio_Marital_status'] = 'StandardAddSal_7'
-            return row
-        df = df.apply(Standard_Add_Sal_7, axis=1) 
-        
-        def Standard_Add_Sal_MaleSp_8(row):
-            global commonTitles
-            if (row['CnBio_Last_Name'] == row['CnSpSpBio_Last_Name']
-                and row['CnBio_Marital_status'] != 'Widowed'
-                and row['CnBio_Marital_status'] == 'Married'
-                and (row['CnBio_Title_1'] in commonTitles or row['CnSpSpBio_Title_1'] in commonTitles)
-                and row['CnSpSpBio_Gender'] == 'Male'
-            ):
-                row['CnBio_Marital_status'] = 'StandardAddSal_MaleSp_8'
-            return row
-        df = df.apply(Standard_Add_Sal_MaleSp_8, axis=1)
-    
-        def blank_names_Unchanged_AddSal(row):
-            # Name info is blank, cannot concatenate a addsal
-            if (pd.isnull(row['CnBio_Last_Name']) and pd.isnull(row['CnBio_First_Name'])):
-                row['CnBio_Marital_status'] = 'Unchanged'
-            return row
-        df = df.apply(blank_names_Unchanged_AddSal, axis=1)
-
-        # fills back in a blank space otherwise it would fill cell with 'nan'
-        df['CnBio_First_Name'] = df['CnBio_First_Name'].loc[:].fillna('')
-        df['CnBio_Last_Name'] = df['CnBio_Last_Name'].loc[:].fillna('')
-        df['CnSpSpBio_First_Name'] = df['CnSpSpBio_First_Name'].loc[:].fillna('')
-        df['CnSpSpBio_Last_Name'] = df['CnSpSpBio_Last_Name'].loc[:].fillna('')
-        df['CnBio_Title_1'] = df['CnBio_Title_1'].loc[:].fillna('')
-        df['CnSpSpBio_Title_1'] = df['CnSpSpBio_Title_1'].loc[:].fillna('')
-
-        def concate_add_sal(row):
-
-            if (row['CnBio_Marital_status'] == 'Unchanged' ):
-            # Unchanged
-            # Not enough data to concatenate a add/sal  
-                addressee = str(row['CnAdrSal_Addressee'])
-                salutation = str(row['CnAdrSal_Salutation'])
-            
-            elif (row['CnBio_Marital_status'] == 'WidSinDiv_0'):
-            # WidSinDiv_0
-            # Mr. Bryce Howard 
-            # Mr. Howard
-                # Check if Last Name is not blank
-                if pd.notnull(row['CnBio_Last_Name']) and row['CnBio_Last_Name'].strip():
-                    addressee = str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_First_Name']) + ' ' + str(row['CnBio_Last_Name'])
-                    salutation = str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_Last_Name'])
-                # If Last Name is blank, use First Name
-                elif pd.notnull(row['CnBio_First_Name']) and row['CnBio_First_Name'].strip():
-                    addressee = str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_First_Name'])
-                    salutation = str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_First_Name'])
-        
-            elif (row['CnBio_Marital_status'] == 'DifferentLastName_1'):
-            # Different_Last_Name_1
-            # Mr. Bryce Howard and Mrs. Jennifer Ha 
-            # Mr. Howard and Mrs. Ha
-                addressee = str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_First_Name']) + ' ' + str(row['CnBio_Last_Name']) +' and ' + str(row['CnSpSpBio_Title_1']) + ' ' + str(row['CnSpSpBio_First_Name']) + ' ' +  str( row['CnSpSpBio_Last_Name'])
-                salutation = str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_Last_Name']) + ' and ' + str(row['CnSpSpBio_Title_1']) + ' ' + str(row['CnSpSpBio_Last_Name'])
-
-            elif (row['CnBio_Marital_status'] == 'SameLastNameSameTitleNonSpecial_2'):
-            # Same_Last_Name_Same_Title_NonSpecial_2
-            # Mr. Bryce Howard and Mr. Branden Howard
-            # Mr Howard and Mr. Howard
-                addressee = str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_First_Name']) + ' ' + str(row['CnBio_Last_Name']) +' and ' + str(row['CnSpSpBio_Title_1']) + ' ' + str(row['CnSpSpBio_First_Name']) + ' ' +  str( row['CnSpSpBio_Last_Name'])
-                salutation = str(row['CnBio_Title_1']) + ' and ' + str(row['CnSpSpBio_Title_1']) + ' ' + str(row['CnBio_Last_Name'])
-
-            elif (row['CnBio_Marital_status'] == 'SameLastNameSameTitleSpecial_3'):
-            # Gives: Same_Last_Name_Same_Title_Special_3
-            # Dr. Bryce Howard and Dr. Jen Howard
-            # Dr. Howard and Dr. Howard
-                addressee = str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_First_Name']) + ' ' + str(row['CnBio_Last_Name']) + ' and ' + str(row['CnSpSpBio_Title_1']) + ' ' + str(row['CnSpSpBio_First_Name']) + ' ' +  str( row['CnSpSpBio_Last_Name'])
-                salutation = str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_Last_Name']) + ' and ' + str(row['CnSpSpBio_Title_1']) + ' ' + str(row['CnSpSpBio_Last_Name'])
-
-            elif (row['CnBio_Marital_status'] == 'SameLastNameBothSpecicalTitle_4'):
-            # Same_Last_Name_Both_Specical_Title_4 
-            # Senator Bryce Howard and Dr. Jen Howard
-            # Senator Howard and Dr. Howard
-                addressee = str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_First_Name']) + ' ' + str(row['CnBio_Last_Name']) + ' and ' + str(row['CnSpSpBio_Title_1']) + ' ' + str(row['CnSpSpBio_First_Name']) + ' ' +  str( row['CnSpSpBio_Last_Name'])
-                salutation = str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_Last_Name']) + ' and ' + str(row['CnSpSpBio_Title_1']) + ' ' + str(row['CnSpSpBio_Last_Name'])
-
-            elif (row['CnBio_Marital_status'] == 'SameLastNameMainSpecicalTitle_5'):
-            # Same_Last_Name_Main_Specical_Title_5 
-            # Dr. Bryce Howard and Mrs. Howard
-            # Dr. Howard and Mrs. Howard
-                addressee = str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_First_Name']) + ' ' + str(row['CnBio_Last_Name']) + ' and ' + str(row['CnSpSpBio_Title_1']) + ' ' +  str( row['CnSpSpBio_Last_Name'])
-                salutation = str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_Last_Name']) + ' and ' + str(row['CnSpSpBio_Title_1']) + ' ' + str(row['CnSpSpBio_Last_Name'])       
-            
-            elif (row['CnBio_Marital_status'] == 'SameLastNameSpSpecicalTitle_6'):
-            # Same_Last_Name_Sp_Specical_Title_6 
-            # Dr. Jennifer Howard and Mr. Bryce Howard
-            # Dr. Howard and Mr. Howard
-                addressee = str(row['CnSpSpBio_Title_1']) + ' ' + str(row['CnSpSpBio_First_Name']) + ' ' + str(row['CnSpSpBio_Last_Name']) + ' and ' + str(row['CnBio_Title_1']) + ' ' +  str( row['CnBio_Last_Name'])
-                salutation = str(row['CnSpSpBio_Title_1']) + ' ' + str(row['CnSpSpBio_Last_Name']) + ' and ' + str(row['CnBio_Title_1']) + ' ' + str(row['CnBio_Last_Name'])      
-            
-            elif (row['CnBio_Marital_status'] == 'StandardAddSal_7'):
-            # Standard_Add_Sal_7
-            # Mr. and Mrs. Bryce Howard
-            # Mr. and Mrs. Howard
-                addressee = str(row['CnBio_Title_1']) + ' and ' + str(row['CnSpSpBio_Title_1']) + ' ' + str(row['CnBio_First_Name']) + ' ' + str(row['CnBio_Last_Name'])
-                salutation = str(row['CnBio_Title_1']) + ' and ' + str(row['CnSpSpBio_Title_1']) + ' ' + str(row['CnBio_Last_Name'])
-
-            elif (row['CnBio_Marital_status'] == 'Standard_Add_Sal_MaleSp_8'):
-                addressee = str(row['CnSpSpBio_Title_1']) + ' and ' + str(row['CnBio_Title_1']) + ' ' + str(row['CnSpSpBio_First_Name']) + ' ' + str(row['CnSpSpBio_Last_Name'])
-                salutation = str(row['CnSpSpBio_Title_1']) + ' and ' + str(row['CnBio_Title_1']) + ' ' + str(row['CnSpSpBio_Last_Name'])
-
+            check_cancelled(self.cancel)
+            base, ext = os.path.splitext(file)
+            report_path = base + '_title_gender_errors' + ext
+            if self.streaming:
+                # Only the columns the checks need, one chunk at a time. The whole file is
+                # checked for the encoding so a late decode error can't cut the output short.
+                file_encoding = sniff_encoding(file, sample_size=None)
+                reader = read_csv_chunks(file, self.rows_per_chunk(file, file_encoding), file_encoding, dtype=str,
+                                         usecols=title_gender_columns)
+                chunks = (apply_label_schema(chunk) for chunk in cancellable(reader, self.cancel))
+                with measure(self.recorder, 'check titles and genders', STEP):
+                    valid = self.check_titles_and_genders(chunks, report_path, file_encoding)
+                df = None
             else:
-            # This will make the add/sal blank, which will help find edge cases. Any add/sal that did not fit the criteria above, will come out blank.
-                addressee = ''
-                salutation = ''
-            return pd.Series({'CnAdrSal_Addressee': addressee, 'CnAdrSal_Salutation': salutation})
-        df[['CnAdrSal_Addressee', 'CnAdrSal_Salutation']] = df.apply(concate_add_sal, axis=1)
-
-        def add_bishop_fields(df):
-            bishop_addressee_data = []
-            bishop_salutation_data = []
-            
-            for index, row in df.iterrows():
-                if pd.isna(row['CnBio_First_Name']) and pd.isna(row['CnBio_Last_Name']):
-                    bishop_addressee_data.append('')
-                    bishop_salutation_data.append('')
-                    continue
-                
-                first_name = row['CnBio_First_Name'] if not pd.isna(row['CnBio_First_Name']) else ''
-                last_name = row['CnBio_Last_Name'] if not pd.isna(row['CnBio_Last_Name']) else ''
-                spouse_first_name = row['CnSpSpBio_First_Name'] if not pd.isna(row['CnSpSpBio_First_Name']) else ''
-
-                if spouse_first_name:
-                    addressee = f"{first_name} and {spouse_first_name} {last_name}"
-                    salutation = f"{first_name} and {spouse_first_name}"
-                else:
-                    addressee = f"{first_name} {last_name}"
-                    salutation = first_name
-                
-                bishop_addressee_data.append(addressee)
-                bishop_salutation_data.append(salutation)
-            
-            new_columns = pd.DataFrame({
-                'Bishop_Addressee': bishop_addressee_data,
-                'Bishop_Salutation': bishop_salutation_data
-            })
-            
-            df = pd.concat([df, new_columns], axis=1)
-
-            columns = df.columns.tolist()
-            columns.insert(12, columns.pop(columns.index('Bishop_Addressee')))
-            columns.insert(13, columns.pop(columns.index('Bishop_Salutation')))
-            df = df[columns]
-            
-            return df
-        df = add_bishop_fields(df)
-
-        # check notes for add/sal requests
-        def update_add_sal_request(df):
-            for index, row in df.iterrows():
-                # Iterate through note columns dynamically
-                note_types = [col for col in df.columns if '_Type' in col]
-                for note_type in note_types:
-                    note_description_col = note_type.replace('_Type', '_Description')
-                    if row[note_type] == 'Add/Sal Request':
-                        df.at[index, 'CnAdrSal_Addressee'] = row[note_description_col]
-                        df.at[index, 'CnAdrSal_Salutation'] = row[note_description_col]
-                        df.at[index, 'CnBio_Marital_status'] = 'Add/Sal Request'
-                        break  # Stop after finding the first matching Add/Sal Request
-
-            return df
-
-        # Apply the new function to the DataFrame
-        df = update_add_sal_request(df)
-
-        base, ext = os.path.splitext(file)
-        new_file = base + '_clean' + ext
-        df.to_csv(f'{new_file}', index=False, encoding=file_encoding)
-        print("\n_export_clean.csv created\nAddress and Salutation processing completed.")
-        return True
-
-    def check_titles_and_genders(self, df):
-        # Collect rows that fail the checks
-
-        failed_rows = []
-
-        for _, row in df.iterrows():
-            if row['CnBio_Gender'] == 'Male' and row['CnBio_Title_1'] in strictly_female_titles:
-                failed_rows.append([row['CnBio_ID'], row['CnBio_Gender'], row['CnBio_Title_1'], row['CnSpSpBio_Gender'], row['CnSpSpBio_Title_1']])
-            if row['CnBio_Gender'] == 'Female' and row['CnBio_Title_1'] in strictly_male_titles:
-                failed_rows.append([row['CnBio_ID'], row['CnBio_Gender'], row['CnBio_Title_1'], row['CnSpSpBio_Gender'], row['CnSpSpBio_Title_1']])
-            if row['CnSpSpBio_Gender'] == 'Male' and row['CnSpSpBio_Title_1'] in strictly_female_titles:
-                failed_rows.append([row['CnBio_ID'], row['CnBio_Gender'], row['CnBio_Title_1'], row['CnSpSpBio_Gender'], row['CnSpSpBio_Title_1']])
-            if row['CnSpSpBio_Gender'] == 'Female' and row['CnSpSpBio_Title_1'] in strictly_male_titles:
-                failed_rows.append([row['CnBio_ID'], row['CnBio_Gender'], row['CnBio_Title_1'], row['CnSpSpBio_Gender'], row['CnSpSpBio_Title_1']])
-            if row['CnBio_First_Name'] and row['CnBio_Gender'] == 'Unknown' and row['CnBio_Title_1'] in strictly_male_titles + strictly_female_titles:
-                failed_rows.append([row['CnBio_ID'], row['CnBio_Gender'], row['CnBio_Title_1'], row['CnSpSpBio_Gender'], row['CnSpSpBio_Title_1']])
-            if row['CnSpSpBio_First_Name'] and row['CnSpSpBio_Gender'] == 'Unknown' and row['CnSpSpBio_Title_1'] in strictly_male_titles + strictly_female_titles:
-                failed_rows.append([row['CnBio_ID'], row['CnBio_Gender'], row['CnBio_Title_1'], row['CnSpSpBio_Gender'], row['CnSpSpBio_Title_1']])
-
-        if failed_rows:
-            print("\nThese some of errors found '_export'. There are potentially more:")
-            print(tb(failed_rows, headers=["CnBio_ID", "Gender", "Title", "SpSpGender", "SpSpTitle"], tablefmt="grid"))
+                with measure(self.recorder, 'read _export.csv', LOAD) as span:
+                    df, file_encoding = self.read_export(file)
+                    span.rows = len(df)
+                with measure(self.recorder, 'check titles and genders', STEP, len(df)):
+                    valid = self.check_titles_and_genders(df, report_path, file_encoding)
+
+            if not valid:
+                print(f"ERROR: {os.path.basename(file)} was not cleaned")
+                all_valid = False
+                continue
+            jobs.append((file, base + '_clean' + ext, file_encoding, df))
+
+        if self.streaming:
+            for file, new_file, file_encoding, _ in jobs:
+                with measure(self.recorder, 'clean in chunks', STEP):
+                    self.clean_file_in_chunks(file, new_file, file_encoding)
+                print(f"\n{os.path.basename(new_file)} created")
+        else:
+            # Partitions of every file share one pool and come back in their original order
+            split = [(new_file, file_encoding, split_rows(df, PARTITION_ROWS)) for _, new_file, file_encoding, df in jobs]
+            workers = self.workers if sum(len(parts) for _, _, parts in split) > 1 else 1
+            cleaned = self.clean_partitions([part for _, _, parts in split for part in parts], workers)
+            for new_file, file_encoding, parts in split:
+                cleaned_parts = []
+                for _ in parts:
+                    cleaned_parts.append(next(cleaned))
+                    check_cancelled(self.cancel)
+                df = pd.concat(cleaned_parts)
+                with measure(self.recorder, 'write _clean.csv', WRITE, len(df)):
+                    save_table(df, new_file, file_encoding)
+                print(f"\n{os.path.basename(new_file)} created")
+
+        if not all_valid:
             return False
-        
+        print("Address and Salutation processing completed.")
         return True
-    
+
+    def read_export(self, file):
+        """Read an _export.csv with the label schema, returning the frame and the encoding used."""
+        df, encoding = read_csv(file, low_memory=False, dtype=str)
+        return apply_label_schema(df), encoding
+
+    def rows_per_chunk(self, file, encoding, workers=1):
+        """Rows to read per chunk, from chunk_size or estimated from max_memory_mb.
+
+        max_memory_mb is shared by every chunk map_partitions keeps in flight with workers.
+        """
+        if self.chunk_size:
+            return self.chunk_size
+        sample, _ = read_csv(file, encoding=encoding, dtype=str, nrows=1000)
+        row_bytes = max(sample.memory_usage(deep=True).sum() / max(len(sample), 1), 1)
+        chunk_bytes = self.max_memory_mb * 2**20 / partitions_in_flight(workers)
+        return max(int(chunk_bytes / (row_bytes * CHUNK_MEMORY_FACTOR)), 1)
+
+    def clean_file_in_chunks(self, file, new_file, encoding):
+        """Clean the export chunk by chunk, appending each one to new_file."""
+        reader = read_csv_chunks(file, self.rows_per_chunk(file, encoding, self.workers), encoding, dtype=str)
+        mode, header = 'w', True
+        try:
+            for chunk in self.clean_partitions(reader, self.workers):
+                check_cancelled(self.cancel)
+                chunk.to_csv(new_file, mode=mode, header=header, index=False, encoding=encoding)
+                mode, header = 'a', False
+        except BaseException:
+            # Don't leave a half written file for the next stage to pick up
+            if os.path.exists(new_file):
+                os.remove(new_file)
+            raise
+        # Chunks can't share one Parquet schema, the next stage reads the CSV
+        remove_intermediate(new_file)
+
+    def check_titles_and_genders(self, df, report_path=None, encoding='utf-8'):
+        """Check every row against TITLE_GENDER_RULES and report all violations.
+
+        df can also be an iterator of chunks. The full list is written to report_path
+        when given, the log only gets a summary.
+        The violations are kept on self.title_gender_errors.
+        """
+        if isinstance(df, pd.DataFrame):
+            errors = find_title_gender_errors(df)
+        else:
+            # Chunks from a streaming read
+            errors = pd.concat([find_title_gender_errors(chunk) for chunk in df], ignore_index=True)
+        self.title_gender_errors = errors
+        if errors.empty:
+            # Don't leave last run's report behind once the records are fixed
+            if report_path and os.path.exists(report_path):
+                os.remove(report_path)
+            return True
+
+        print(f"\n{len(errors)} title/gender errors found in {errors['CnBio_ID'].nunique()} records of '_export':")
+        summary = errors.groupby(['Rule', 'Columns'], sort=False).size().reset_index(name='Records')
+        print(tb(summary, headers='keys', tablefmt='grid', showindex=False))
+        if report_path:
+            errors.to_csv(report_path, index=False, encoding=encoding)
+            print(f"Full list of errors saved to {os.path.basename(report_path)}")
+        return False
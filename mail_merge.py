@@ -1,158 +1,540 @@
+import numpy as np
 import pandas as pd
 from docx import Document
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.opc.part import XmlPart
+from docx.oxml.ns import qn
+import io
 import os
+import re
 import glob
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from copy import deepcopy
+from itertools import chain, count, repeat
+from lxml import etree
+from xml.sax.saxutils import escape, unescape
+from csv_reader import dates_as_csv_text, read_csv, read_table
 from docxcompose.composer import Composer
-from docx import Document as Document_compose
-from PySide6.QtCore import QObject, Signal, QThread, QIODevice 
-from PySide6.QtWidgets import QTextEdit
-from PySide6.QtGui import QTextCursor
+from progress import Cancelled, ProgressReporter, check_cancelled, format_progress
+from timings import LOAD, STEP, WRITE, measure
 import time
-from threading import Thread
 
-class CleanupAnimationThread(Thread):
-    def __init__(self, logger):
-        super().__init__()
-        self.logger = logger
-        self.running = True
-        self.cleanup_states = [
-            "Cleaning up mail merge files",
-            "Cleaning up mail merge files.",
-            "Cleaning up mail merge files..",
-            "Cleaning up mail merge files...",
-            "Cleaning up mail merge files....",
-            "Cleaning up mail merge files.....",
-            "Cleaning up mail merge files....",
-            "Cleaning up mail merge files...",
-            "Cleaning up mail merge files..",
-            "Cleaning up mail merge files."
-        ]
-
-    def run(self):
-        while self.running:
-            for state in self.cleanup_states:
-                if not self.running:
-                    break
-                self.logger.log(state, update_only=True)
-                time.sleep(0.5)  # Adjust the sleep time to control the speed of the animation
-
-    def stop(self):
-        self.running = False
-
-class Logger(QObject):
-    log_signal = Signal(str, bool)
-
-    def __init__(self):
-        super().__init__()
-
-    def log(self, message, update_only=False):
-        self.log_signal.emit(message, update_only)
-
-class Worker(QThread):
-    progress = Signal(str, bool)
-    finished = Signal(str)
-
-    def __init__(self, output_dir, template_path):
-        super().__init__()
-        self.output_dir = output_dir
+# A merge field in a template, e.g. «Addressee», named after a column of the data
+PLACEHOLDER = re.compile(r'«([^«»]+)»')
+
+# Merge fields and drawing ids in the serialized body of a template. Drawing ids must be
+# unique in a document, so each streamed letter gets new ones.
+BODY_SLOT = re.compile(r'«([^«»<]+)»|(?<=<wp:docPr id=")\d+')
+
+# Characters XML can't hold, which python-docx refuses. Some RE fields carry them, e.g. a
+# vertical tab for a line break, and they are dropped from the merged text.
+XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+def field_text(value):
+    """A data value as the text that replaces its merge field."""
+    return XML_ILLEGAL.sub('', str(value))
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+PAGE_BREAK = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+
+class CompiledTemplate:
+    """A DOCX template unzipped and parsed once, with an index of its merge fields.
+
+    The index covers the body, tables, headers and footers. It lists each text run that
+    holds a «field» with the run's template text, so a letter only rewrites those runs and
+    every run keeps its formatting. render() swaps a fresh copy of the parsed XML into the
+    template's parts and returns it as a new document. A rendered document is only valid
+    until the next render() call.
+    """
+    def __init__(self, template_path):
         self.template_path = template_path
+        document = Document(template_path)
+        self.part = document.part
+        story_parts = [rel.target_part for rel in self.part.rels.values()
+                       if rel.reltype in (RT.HEADER, RT.FOOTER) and not rel.is_external]
+
+        # (part, pristine XML, [(run position, template text), ...]) for every part to render
+        self._stories = []
+        self.fields = set()
+        for part in [self.part] + story_parts:
+            for paragraph in part._element.iter(qn('w:p')):
+                _join_split_fields(paragraph)
+            slots = []
+            for position, text in enumerate(part._element.iter(qn('w:t'))):
+                fields = PLACEHOLDER.findall(text.text or '')
+                if fields:
+                    text.set(qn('xml:space'), 'preserve')
+                    slots.append((position, text.text))
+                    self.fields.update(fields)
+            if part is self.part or slots:
+                self._stories.append((part, deepcopy(part._element), slots))
+
+    def render(self, row):
+        """Fill the template with row, a mapping of field name to value.
+
+        Fields missing from row are left as they are.
+        """
+        def value(match):
+            name = match.group(1)
+            return field_text(row[name]) if name in row else match.group(0)
+
+        for part, element, slots in self._stories:
+            part._element = deepcopy(element)
+            if slots:
+                texts = list(part._element.iter(qn('w:t')))
+                for position, text in slots:
+                    texts[position].text = PLACEHOLDER.sub(value, text)
+        return self.part.document
+
+    def render_standalone(self, row):
+        """Like render(), but the document has its own copy of the package and stays valid."""
+        buffer = io.BytesIO()
+        self.render(row).save(buffer)
+        buffer.seek(0)
+        return Document(buffer)
+
+    def stream(self, output_path, rows):
+        """Write one letter per row, a mapping of field name to value, into output_path.
+
+        Only word/document.xml is generated. It is written into the zip one letter at a
+        time, with a page break between letters, so memory stays flat however many rows
+        there are. Styles, numbering, media and every other part are copied from the
+        template once, and headers and footers are filled with the first row. Yields
+        after each letter is written.
+
+        The letters go to a temporary file next to output_path that replaces it once the
+        last letter is written, so a failed or closed run leaves no partial file behind.
+        """
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return
+        head, segments, slots, tail, page_break = self._body_xml()
+
+        # Headers and footers with fields, filled once
+        self.render(first)
+        rendered = {part.partname: part.blob for part, element, story_slots in self._stories[1:]}
+
+        drawing_ids = count(self._next_drawing_id())
+        partial_path = output_path + '.partial'
+        try:
+            with zipfile.ZipFile(self.template_path) as source, \
+                    zipfile.ZipFile(partial_path, 'w', zipfile.ZIP_DEFLATED) as target:
+                for item in source.infolist():
+                    partname = '/' + item.filename
+                    if partname != self.part.partname:
+                        target.writestr(item.filename, rendered.get(partname) or source.read(item))
+
+                info = zipfile.ZipInfo(self.part.partname.lstrip('/'), time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with target.open(info, 'w', force_zip64=True) as document_xml:
+                    document_xml.write((XML_DECLARATION + head).encode('utf-8'))
+                    for index, row in enumerate(chain([first], rows)):
+                        letter = [segments[0]]
+                        for (name, text), segment in zip(slots, segments[1:]):
+                            if name is None:
+                                letter.append(str(next(drawing_ids)))
+                            else:
+                                letter.append(escape(field_text(row[name])) if name in row else text)
+                            letter.append(segment)
+                        if index and page_break:
+                            document_xml.write(PAGE_BREAK.encode('utf-8'))
+                        document_xml.write(''.join(letter).encode('utf-8'))
+                        yield
+                    document_xml.write(tail.encode('utf-8'))
+            os.replace(partial_path, output_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    def _body_xml(self):
+        """Split the serialized template body around its fields and drawing ids.
+
+        Returns the document XML before the letter, the letter's text segments, the slots
+        between them as (field name or None for a drawing id, template text), the XML after
+        the letter, and whether letters need a page break between them.
+        """
+        element = deepcopy(self._stories[0][1])
+        body = element.find(qn('w:body'))
+        blocks = [child for child in body if child.tag != qn('w:sectPr')]
+        # No extra break when the template already ends on one
+        page_break = not (blocks and any(br.get(qn('w:type')) == 'page' for br in blocks[-1].iter(qn('w:br'))))
+
+        # Comments mark where the letter starts and ends in the serialized document
+        body.insert(0, etree.Comment('letter'))
+        section = body.find(qn('w:sectPr'))
+        if section is not None:
+            section.addprevious(etree.Comment('end'))
+        else:
+            body.append(etree.Comment('end'))
+        head, rest = etree.tostring(element, encoding='unicode').split('<!--letter-->')
+        letter, tail = rest.split('<!--end-->')
+
+        segments = []
+        slots = []
+        start = 0
+        for match in BODY_SLOT.finditer(letter):
+            segments.append(letter[start:match.start()])
+            slots.append((unescape(match.group(1)) if match.group(1) else None, match.group(0)))
+            start = match.end()
+        segments.append(letter[start:])
+        return head, segments, slots, tail, page_break
+
+    def _next_drawing_id(self):
+        """An id above every drawing id used in the template's parts."""
+        ids = [int(drawing.get('id', 0)) for part in self.part.package.iter_parts() if isinstance(part, XmlPart)
+               for drawing in part._element.iter(qn('wp:docPr'))]
+        return max(ids, default=0) + 1
+
+def _join_split_fields(paragraph):
+    """Move each «field» that Word split over several runs into the run where it starts."""
+    texts = [t for t in paragraph.iter(qn('w:t')) if next(t.iterancestors(qn('w:p'))) is paragraph]
+    if len(texts) < 2:
+        return
+    # Moving text between runs doesn't change the paragraph text, so the matches stay valid
+    for match in PLACEHOLDER.finditer(''.join(t.text or '' for t in texts)):
+        offset = 0
+        first = None
+        for t in texts:
+            text = t.text or ''
+            if first is None and match.start() < offset + len(text):
+                first, start = t, match.start() - offset
+            if first is not None and match.end() <= offset + len(text):
+                last, end = t, match.end() - offset
+                break
+            offset += len(text)
+        if first is last:
+            continue
+        # The runs in between only held part of the field
+        between = texts[texts.index(first) + 1:texts.index(last)]
+        first.text = (first.text or '') + ''.join(t.text or '' for t in between) + (last.text or '')[:end]
+        last.text = (last.text or '')[end:]
+        for t in between:
+            t.text = ''
+        for t in (first, last):
+            t.set(qn('xml:space'), 'preserve')
+
+# Letters rendered and composed by one pool task. Shards are then combined in pairs.
+SHARD_ROWS = 250
+
+# Compiled templates of this process, by path and modification time
+_templates = {}
+
+def compiled_template(template_path):
+    key = (template_path, os.path.getmtime(template_path))
+    if key not in _templates:
+        _templates.clear()
+        _templates[key] = CompiledTemplate(template_path)
+    return _templates[key]
 
-    def run(self):
+def compose_documents(documents):
+    """Append documents, an iterable, in order onto the first one. Returns the composer.
+
+    Documents are combined in memory, nothing is written until the composer is saved.
+    """
+    documents = iter(documents)
+    composer = Composer(next(documents))
+    for doc in documents:
+        composer.append(doc)
+    return composer
+
+def document_bytes(document):
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+def render_shard(template_path, columns, rows, on_letter=None):
+    """Render rows, tuples of values in columns order, into one document returned as .docx bytes.
+
+    Runs on a pool process, which keeps the compiled template for its next shard.
+    on_letter is called after each letter, when the shard is rendered in this process.
+    """
+    template = compiled_template(template_path)
+
+    # The first letter becomes the shard's document so it needs its own package.
+    # The others are rendered one at a time as the composer asks for them.
+    def letters():
+        for index, values in enumerate(rows):
+            row = dict(zip(columns, values))
+            yield template.render_standalone(row) if index == 0 else template.render(row)
+            if on_letter:
+                on_letter()
+
+    return document_bytes(compose_documents(letters()).doc)
+
+def combine_shards(first, second):
+    """Append the second .docx (bytes) to the first, returning the combined .docx bytes."""
+    return document_bytes(compose_documents(Document(io.BytesIO(shard)) for shard in (first, second)).doc)
+
+def write_batch(template_path, columns, rows, output_path, streaming=False):
+    """Write rows, tuples of values in columns order, as one merged file. Returns the row count."""
+    if streaming:
+        for _ in compiled_template(template_path).stream(output_path, (dict(zip(columns, values)) for values in rows)):
+            pass
+    else:
+        document = render_shard(template_path, columns, rows)
         try:
-            latest_csv = find_latest_complete_csv(self.output_dir)
-            self.progress.emit(f"Latest CSV file found: {latest_csv}", False)
-            logger = Logger()
-            logger.log_signal.connect(self.log)
-            mail_merge = MailMerge(self.output_dir, logger)
-            mail_merge.merge(latest_csv, self.template_path)
-            self.finished.emit("")
-        except Exception as e:
-            self.finished.emit(f"An error occurred during mail merge: {e}")
-
-    def log(self, message, update_only=False):
-        self.progress.emit(message, update_only)
+            with open(output_path, 'wb') as f:
+                f.write(document)
+        except BaseException:
+            # e.g. a full disk, don't leave a truncated file under the final name
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
+    return len(rows)
+
+def _run_now(func, *args):
+    """A finished Future holding func(*args), for runs without a process pool."""
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def batch_label(value):
+    """A grouping value as it can appear in a file name."""
+    return re.sub(r'[\\/:*?"<>|\s]+', ' ', str(value)).strip() or 'blank'
+
+class BatchesFailed(Exception):
+    """Raised by merge_batches once the other files are written. labels are the ones that failed."""
+    def __init__(self, message, labels):
+        super().__init__(message)
+        self.labels = labels
 
 class MailMerge:
-    def __init__(self, output_dir, logger):
+    def __init__(self, output_dir, logger, workers=None, streaming=False, batch_size=None, group_by=None, progress=None,
+                 cancel=None, recorder=None):
+        """workers is the size of the process pool rendering the shards, all cores by default.
+
+        streaming writes the letters straight into the output file instead, see
+        CompiledTemplate.stream. It keeps memory flat for very large runs.
+
+        batch_size splits the output into files of at most that many letters, group_by
+        into one file per value of that column. The files are written concurrently.
+
+        progress is called with a Progress a few times a second at most, see progress.py.
+        Without it progress is logged as one updating line.
+
+        cancel is a threading.Event checked between letters, shards and files. Setting it
+        raises progress.Cancelled, with no partly written output left behind.
+
+        recorder is a timings.Recorder that gets the load, the template compile, the
+        rendering and combining of the letters and the write.
+        """
         self.output_dir = output_dir
         self.logger = logger
+        self.progress = ProgressReporter(progress or self.log_progress)
+        self.cancel = cancel
+        self.recorder = recorder
+        self.workers = workers
+        self.streaming = streaming
+        self.batch_size = batch_size
+        self.group_by = group_by
 
     def read_csv_file(self, file_path):
-        """Attempt to read a CSV file with multiple encodings."""
-        try:
-            # Try reading with UTF-8 first
-            return pd.read_csv(file_path, encoding='utf-8'), 'utf-8'
-        except UnicodeDecodeError:
-            # If UTF-8 fails, try ISO-8859-1
-            return pd.read_csv(file_path, encoding='ISO-8859-1'), 'ISO-8859-1'
+        """Read a CSV file with its sniffed encoding, returning the frame and the encoding."""
+        return read_csv(file_path)
+
+    def letter_rendered(self):
+        self.progress.advance()
+        check_cancelled(self.cancel)
 
-    def merge(self, data_path, template_path):
-        # Read the data
-        df, encoding = self.read_csv_file(data_path)
+    def log_progress(self, progress):
+        self.logger.log(format_progress(progress), update_only=True)
+
+    def merge(self, data_path, template_path, batches=None):
+        """Merge every row of data_path into template_path.
+
+        batches limits a batch_size or group_by run to the files with those labels, e.g.
+        to write again one that failed.
+        """
+        # Read the data, from the typed intermediate when the ack stage left one. The CSV
+        # is read as text so IDs and ZIP codes keep their leading zeros, like the
+        # intermediate's text columns. Blank cells merge as empty text rather than 'nan'.
+        with measure(self.recorder, 'read _complete.csv', LOAD) as span:
+            df, encoding = read_table(data_path, dtype=str)
+            df = dates_as_csv_text(df).fillna('')
+            span.rows = len(df)
+        check_cancelled(self.cancel)
 
         self.logger.log(f"Starting mail merge process")
         self.logger.log(f"{len(df)} mail merges will be performed")
 
         self.logger.log(f"Beginning mail merge using '{os.path.basename(template_path)}'")
 
-        # Process each row in the data
-        for index, row in df.iterrows():
-            # Load the template document
-            doc = Document(template_path)
+        # Parse and index the template once here to check its fields, the pool processes
+        # compile their own copy once each
+        with measure(self.recorder, 'compile template', STEP):
+            template = compiled_template(template_path)
+        unknown_fields = template.fields.difference(df.columns)
+        if unknown_fields:
+            self.logger.log(f"Template fields with no column in the data, left as is: {', '.join(sorted(unknown_fields))}")
 
-            # Replace placeholders with actual data
-            for paragraph in doc.paragraphs:
-                self._replace_placeholders(paragraph, row)
+        if df.empty:
+            self.logger.log("No rows to merge")
+            return
 
-            # Save the personalized document
-            output_path = os.path.join(self.output_dir, f"merged_letter_{index}.docx")
-            doc.save(output_path)
+        if self.batch_size or self.group_by:
+            with measure(self.recorder, 'write batches', WRITE, len(df)):
+                self.merge_batches(df, template_path, batches)
+            return
 
-            # Update progress
-            self.logger.log(f"Mail merging is working on {index + 1} out of {len(df)}", update_only=True)
+        # Rows are read straight from the column arrays
+        columns = list(df.columns)
+        base_name = os.path.basename(template_path)
+        if self.streaming:
+            rows = (dict(zip(columns, values)) for values in zip(*(df[column].to_numpy() for column in columns)))
+            output_path = os.path.join(self.output_dir, f"Merged_{base_name}")
+            self.progress.start('Merging letters', len(df))
+            letters = template.stream(output_path, rows)
+            try:
+                with measure(self.recorder, 'stream letters', WRITE, len(df)):
+                    for done, _ in enumerate(letters, 1):
+                        self.progress.update(done)
+                        check_cancelled(self.cancel)
+            finally:
+                # Removes the partial file when the letters stopped early
+                letters.close()
+            self.logger.log("the '_complete.csv' file is the data source for the merged docx.\nMail merge complete")
+            return
 
-        # Start the cleanup animation thread
-        cleanup_thread = CleanupAnimationThread(self.logger)
-        cleanup_thread.start()
+        # Shards are cut in row order
+        rows = list(zip(*(df[column].to_numpy() for column in columns)))
+        shards = [rows[start:start + SHARD_ROWS] for start in range(0, len(rows), SHARD_ROWS)]
 
-        try:
-            # Combine individual documents into a single document
-            self.combine_documents(template_path)
+        workers = self.workers or os.cpu_count() or 1
+        if len(shards) == 1:
+            workers = 1
 
-            # Clean up individual merged files after combining
-            self.cleanup_individual_files()
-        finally:
-            # Stop the cleanup animation thread
-            cleanup_thread.stop()
-            cleanup_thread.join()
+        with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor:
+            # map keeps the shards in row order whichever finishes first
+            pool_map = executor.map if executor else map
+            try:
+                documents = []
+                self.progress.start('Merging letters', len(df))
+                with measure(self.recorder, 'render shards', STEP, len(df)):
+                    if executor:
+                        rendered = executor.map(render_shard, repeat(template_path), repeat(columns), shards)
+                    else:
+                        # Rendered here, progress and cancel follow each letter instead of each shard
+                        rendered = (render_shard(template_path, columns, shard, self.letter_rendered) for shard in shards)
+                    for document in rendered:
+                        documents.append(document)
+                        if executor:
+                            self.progress.advance(len(shards[len(documents) - 1]))
+                        check_cancelled(self.cancel)
+
+                # Combine neighbouring shards in pairs until one document is left, so no
+                # document is appended to more than log2(shards) times
+                self.progress.start(f"Combining parts into 'Merged_{base_name}'", len(documents) - 1)
+                with measure(self.recorder, 'combine shards', STEP, len(documents)):
+                    while len(documents) > 1:
+                        combined = []
+                        for document in pool_map(combine_shards, documents[0::2], documents[1::2]):
+                            combined.append(document)
+                            self.progress.advance()
+                            check_cancelled(self.cancel)
+                        if len(documents) % 2:
+                            combined.append(documents[-1])
+                        documents = combined
+            except Cancelled:
+                if executor:
+                    # Drop the shards not started yet instead of waiting for them
+                    executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        with measure(self.recorder, 'write docx', WRITE, len(df)):
+            with open(os.path.join(self.output_dir, f"Merged_{base_name}"), 'wb') as f:
+                f.write(documents[0])
 
         self.logger.log("the '_complete.csv' file is the data source for the merged docx.\nMail merge complete")
 
-    def _replace_placeholders(self, paragraph, data):
-        for key, value in data.items():
-            if key in paragraph.text:
-                paragraph.text = paragraph.text.replace(f"«{key}»", str(value))
+    def split_batches(self, df):
+        """Return [(label, row positions), ...] for the output files, rows in data order.
 
-    def combine_documents(self, template_path):
-        files = sorted(glob.glob(os.path.join(self.output_dir, 'merged_letter_*.docx')))
-        merged_document = Document_compose(files[0])
-        composer = Composer(merged_document)
+        With group_by the files follow the order each value first appears in.
+        """
+        if self.group_by:
+            if self.group_by not in df.columns:
+                raise ValueError(f"Column '{self.group_by}' to split the letters by is not in the data")
+            codes, values = pd.factorize(df[self.group_by])
+            order = np.argsort(codes, kind='stable')
+            groups = np.split(order, np.cumsum(np.bincount(codes, minlength=len(values)))[:-1])
+            batches = []
+            labels = set()
+            for value, positions in zip(values, groups):
+                label = batch_label(value)
+                # Values that only differ by characters a file name can't hold
+                suffix = 2
+                while label in labels:
+                    label = f"{batch_label(value)} ({suffix})"
+                    suffix += 1
+                labels.add(label)
+                batches.append((label, positions))
+            return batches
 
-        for file in files[1:]:
-            doc = Document_compose(file)
-            composer.append(doc)
+        width = len(str(len(df)))
+        return [(f"{start + 1:0{width}d}-{min(start + self.batch_size, len(df)):0{width}d}",
+                 np.arange(start, min(start + self.batch_size, len(df))))
+                for start in range(0, len(df), self.batch_size)]
 
-        base_name = os.path.basename(template_path)
-        output_path = os.path.join(self.output_dir, f"Merged_{base_name}")
-        composer.save(output_path)
+    def merge_batches(self, df, template_path, labels=None):
+        """Write one Merged_<template> - <label>.docx per batch, several at a time on the pool.
 
-    def cleanup_individual_files(self):
-        files = glob.glob(os.path.join(self.output_dir, 'merged_letter_*.docx'))
-        for file in files:
-            os.remove(file)
+        A batch that fails is logged and the others are still written, then BatchesFailed
+        lists the failed ones. labels that match no batch raise ValueError before anything
+        is written.
+        """
+        stem, ext = os.path.splitext(os.path.basename(template_path))
+        columns = list(df.columns)
+        rows = list(zip(*(df[column].to_numpy() for column in columns)))
+        batches = self.split_batches(df)
+        if labels is not None:
+            unknown = [label for label in labels if label not in {label for label, _ in batches}]
+            if unknown:
+                raise ValueError(f"No batch named {', '.join(unknown)}. The batches are: "
+                                 f"{', '.join(label for label, _ in batches)}")
+        jobs = {label: [rows[position] for position in positions]
+                for label, positions in batches if labels is None or label in labels}
+        total = sum(len(batch) for batch in jobs.values())
+        self.logger.log(f"Writing {len(jobs)} files")
+
+        workers = min(self.workers or os.cpu_count() or 1, len(jobs))
+        failed = []
+        self.progress.start('Merging letters', total)
+        with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor:
+            futures = {}
+            try:
+                for label, batch in jobs.items():
+                    check_cancelled(self.cancel)
+                    args = (write_batch, template_path, columns, batch,
+                            os.path.join(self.output_dir, f"Merged_{stem} - {label}{ext}"), self.streaming)
+                    futures[executor.submit(*args) if executor else _run_now(*args)] = label
+                for future in as_completed(futures):
+                    try:
+                        self.progress.advance(future.result())
+                    except Exception as e:
+                        failed.append(futures[future])
+                        self.logger.log(f"'Merged_{stem} - {futures[future]}{ext}' could not be written: {e}")
+                    check_cancelled(self.cancel)
+            except Cancelled:
+                if executor:
+                    # Drop the files not started yet, the ones being written are finished
+                    executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        if failed:
+            raise BatchesFailed(f"{len(failed)} of {len(jobs)} files failed, write just those again with --batches in "
+                                f"ack_batch.py or MERGE_BATCHES in the GUI: {', '.join(sorted(failed))}", sorted(failed))
+        self.logger.log("the '_complete.csv' file is the data source for the merged docx.\nMail merge complete")
 
 def find_docx_template(input_dir):
-    list_of_files = glob.glob(os.path.join(input_dir, '*.docx'))
+    # Merged_*.docx are outputs of an earlier merge, Word lock files start with ~$
+    list_of_files = [f for f in glob.glob(os.path.join(input_dir, '*.docx'))
+                     if not os.path.basename(f).startswith(('Merged_', '~$'))]
     if len(list_of_files) == 1:
         return list_of_files[0]
     else:
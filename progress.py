@@ -0,0 +1,71 @@
+import time
+from collections import namedtuple
+
+# Seconds between two progress reports. Updates in between are folded into the next one.
+PROGRESS_INTERVAL = 0.2
+
+# One report: the stage running, rows done out of total, rows per second and the
+# estimated seconds left (None until there is a rate to estimate from)
+Progress = namedtuple('Progress', ['stage', 'done', 'total', 'rate', 'eta'])
+
+def format_progress(progress):
+    """'Merging letters: 120 of 5000 (45/s, 1:48 left)'"""
+    text = f"{progress.stage}: {progress.done} of {progress.total}"
+    if progress.eta is not None:
+        minutes, seconds = divmod(int(progress.eta), 60)
+        rate = f"{progress.rate:.0f}" if progress.rate >= 10 else f"{progress.rate:.1f}"
+        text += f" ({rate}/s, {minutes}:{seconds:02d} left)"
+    return text
+
+class Cancelled(Exception):
+    """Raised by check_cancelled when the running stage was cancelled."""
+
+def check_cancelled(cancel):
+    """Raise Cancelled if cancel, a threading.Event or None, is set.
+
+    Stages call this between rule passes, chunks and files so they stop at a clean point.
+    """
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+
+def cancellable(items, cancel):
+    """Yield items, checking cancel before each one."""
+    for item in items:
+        check_cancelled(cancel)
+        yield item
+
+class ProgressReporter:
+    """Coalesces progress updates and passes at most one Progress per interval to report.
+
+    The first and last update of a stage are always reported. report is called from the
+    thread doing the work.
+    """
+    def __init__(self, report, interval=PROGRESS_INTERVAL):
+        self.report = report
+        self.interval = interval
+        self.stage = None
+
+    def start(self, stage, total):
+        self.stage = stage
+        self.total = total
+        self.done = 0
+        self.started = time.monotonic()
+        self.last_report = None
+        self._report()
+
+    def update(self, done):
+        """Set the rows done so far in the current stage."""
+        self.done = done
+        if done >= self.total or time.monotonic() - self.last_report >= self.interval:
+            self._report()
+
+    def advance(self, rows=1):
+        self.update(self.done + rows)
+
+    def _report(self):
+        now = time.monotonic()
+        elapsed = now - self.started
+        rate = self.done / elapsed if self.done and elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate else None
+        self.last_report = now
+        self.report(Progress(self.stage, self.done, self.total, rate, eta))
@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from tabulate import tabulate as tb
+
+# Kinds of span, in the order they are listed in the summary
+STAGE = 'stage'
+LOAD = 'load'
+STEP = 'step'
+RULE = 'rule'
+WRITE = 'write'
+
+class Span:
+    """One measured part of a run: a stage, a CSV load or write, a step or a label rule.
+
+    rows is how many rows it worked on, changed how many of them a label rule updated.
+    peak_mb is the most memory it allocated on top of what was in use when it started,
+    only measured by a Recorder with memory=True.
+    """
+    def __init__(self, name, kind, rows=None):
+        self.name = name
+        self.kind = kind
+        self.rows = rows
+        self.changed = None
+        self.start = None
+        self.seconds = None
+        self.peak_mb = None
+        self.pid = os.getpid()
+        self.thread = threading.get_native_id()
+
+    def as_dict(self):
+        return {'name': self.name, 'kind': self.kind, 'start': self.start, 'seconds': self.seconds,
+                'rows': self.rows, 'changed': self.changed, 'peak_mb': self.peak_mb, 'pid': self.pid,
+                'thread': self.thread}
+
+def measure(recorder, name, kind, rows=None):
+    """recorder.measure(name, kind, rows), or a span that is not kept when recorder is None.
+
+    Used as `with measure(self.recorder, 'read _mail.csv', LOAD) as span: ...`, setting
+    span.rows or span.changed inside the block when they are only known there.
+    """
+    if recorder is None:
+        return nullcontext(Span(name, kind, rows))
+    return recorder.measure(name, kind, rows)
+
+class Recorder:
+    """Collects the Spans of a run and reports them as a table, JSON or a Chrome trace.
+
+    Spans can be nested, a stage holds its loads and steps and a step its rules. One thread
+    measures at a time. memory=True also traces peak memory with tracemalloc, which slows
+    the run down a lot, so it is off unless asked for.
+    """
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.spans = []
+        # Spans being measured, innermost last, for the memory peaks
+        self.open_spans = []
+        self.started_tracing = False
+
+    @contextmanager
+    def measure(self, name, kind, rows=None):
+        span = Span(name, kind, rows)
+        if self.memory:
+            self._start_memory(span)
+        # perf_counter is system wide, so spans from pool processes line up with these
+        span.start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.seconds = time.perf_counter() - span.start
+            if self.memory:
+                self._stop_memory(span)
+            self.spans.append(span)
+
+    def _start_memory(self, span):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        current, peak = tracemalloc.get_traced_memory()
+        if self.open_spans:
+            # The peak so far belongs to the enclosing span
+            self.open_spans[-1].peak = max(self.open_spans[-1].peak, peak)
+        tracemalloc.reset_peak()
+        span.base = span.peak = current
+        self.open_spans.append(span)
+
+    def _stop_memory(self, span):
+        peak = max(span.peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        self.open_spans.pop()
+        span.peak_mb = (peak - span.base) / 2**20
+        del span.base, span.peak
+        if self.open_spans:
+            self.open_spans[-1].peak = max(self.open_spans[-1].peak, peak)
+        elif self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def collect(self, results):
+        """Yield the values of (value, spans) results from pool processes, keeping their spans."""
+        for value, spans in results:
+            self.spans.extend(spans)
+            yield value
+
+    def summary(self):
+        """One dict per kind and name with its runs, total seconds and rows, rows changed
+        and largest peak. Kinds are in the order of STAGE to WRITE, names in the order they
+        first ran, so the label rules keep the order of LABEL_RULES."""
+        totals = {}
+        for span in sorted(self.spans, key=lambda span: span.start):
+            total = totals.setdefault((span.kind, span.name), {
+                'kind': span.kind, 'name': span.name, 'runs': 0, 'seconds': 0.0, 'rows': None,
+                'changed': None, 'peak_mb': None})
+            total['runs'] += 1
+            total['seconds'] += span.seconds
+            for key in ('rows', 'changed'):
+                if getattr(span, key) is not None:
+                    total[key] = (total[key] or 0) + getattr(span, key)
+            if span.peak_mb is not None:
+                total['peak_mb'] = max(total['peak_mb'] or 0.0, span.peak_mb)
+        kinds = [STAGE, LOAD, STEP, RULE, WRITE]
+        return sorted(totals.values(), key=lambda total: kinds.index(total['kind']) if total['kind'] in kinds else len(kinds))
+
+    def summary_table(self):
+        headers = ['Kind', 'Name', 'Runs', 'Seconds', 'Rows', 'Changed']
+        if self.memory:
+            headers.append('Peak MB')
+        rows = []
+        for total in self.summary():
+            row = [total['kind'], total['name'], total['runs'], f"{total['seconds']:.3f}",
+                   '' if total['rows'] is None else total['rows'],
+                   '' if total['changed'] is None else total['changed']]
+            if self.memory:
+                row.append('' if total['peak_mb'] is None else f"{total['peak_mb']:.1f}")
+            rows.append(row)
+        return tb(rows, headers=headers, tablefmt='grid')
+
+    def save_json(self, path):
+        """Every span and the summary, with start in seconds from the first span."""
+        origin = min((span.start for span in self.spans), default=0.0)
+        spans = [dict(span.as_dict(), start=span.start - origin) for span in sorted(self.spans, key=lambda span: span.start)]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'spans': spans, 'summary': self.summary()}, f, indent=1)
+
+    def save_chrome_trace(self, path):
+        """A trace file for chrome://tracing or https://ui.perfetto.dev, one row per process and thread."""
+        origin = min((span.start for span in self.spans), default=0.0)
+        events = []
+        for span in self.spans:
+            args = {key: value for key, value in (('rows', span.rows), ('changed', span.changed), ('peak_mb', span.peak_mb))
+                    if value is not None}
+            events.append({'name': span.name, 'cat': span.kind, 'ph': 'X', 'ts': (span.start - origin) * 1e6,
+                           'dur': span.seconds * 1e6, 'pid': span.pid, 'tid': span.thread, 'args': args})
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)